@@ -1,20 +1,27 @@
 import settings
 from enum import Enum
 from ast import literal_eval
-import requests
+import transport
+import tokenizer
+import server
 from server import load, Model
 import re
 import json
-from typing import Generator
+import sys
+import threading
+import asyncio
+from collections import OrderedDict
+from typing import Generator, AsyncGenerator, Awaitable, Iterable
 from utils import log, LogType
 import traceback
 
-host = f"{settings.llama_host}:{str(settings.llama_port)}"
-completion_endpoint = f"{host}/completion"
-chat_endpoint = f"{host}/v1/chat/completions"
-infill_endpoint = f"{host}/infill"
-tokenize_endpoint = f"{host}/tokenize"
-detokenize_endpoint = f"{host}/detokenize"
+# Endpoint paths, relative to the host `load` returns for each model
+completion_endpoint = "/completion"
+chat_endpoint = "/v1/chat/completions"
+infill_endpoint = "/infill"
+tokenize_endpoint = "/tokenize"
+detokenize_endpoint = "/detokenize"
+slots_endpoint = "/slots"
 
 # Strip any escaped stops.
 GLOBAL_STOPS = [
@@ -138,6 +145,8 @@ class SpecialReturn:
     def __init__(self, return_type=None, n_probs=None):
         self.return_type = return_type
         self.n_probs = n_probs
+        # Final server response, filled in by streamed calls
+        self.value = None
 
     # Probabilities printed as tree graphs.
     @staticmethod
@@ -195,33 +204,158 @@ def _logprob_trees(logprobs: list, n_decimals: int = 3):
                 
         return "\n\n".join(trees)
 
-def _stream(response):
-    for chunk in response.iter_lines():
-        if chunk:
-            chunk_data = json.loads(chunk.decode('utf-8')[6:])  # Remove 'data: ' prefix
-            if "choices" in chunk_data and chunk_data["choices"]:
-                delta = chunk_data["choices"][0].get("delta", {})
-                if "content" in delta:
-                    content = str(delta["content"])
-                    yield content
-
-def tokenize(string: str, count: bool = False) -> list[int]:
-    load()
-    response = requests.post(tokenize_endpoint, json={"content": string}).json()
-    if count:
-        return len(response["tokens"])
-    return response["tokens"]
+# Running token totals for non-streamed generations
+usage = {"prompt_tokens": 0, "completion_tokens": 0, "requests": 0}
+_usage_lock = threading.Lock()
+
+def _track_usage(prompt_tokens: int, completion_tokens: int):
+    with _usage_lock:
+        usage["prompt_tokens"] += int(prompt_tokens)
+        usage["completion_tokens"] += int(completion_tokens)
+        usage["requests"] += 1
+
+def reset_usage():
+    with _usage_lock:
+        for key in usage:
+            usage[key] = 0
 
-def detokenize(tokens: list, return_list: bool = False) -> list[str]:
-    load()
+def _stream(response, special_return: SpecialReturn = None):
+    """
+    Yield streamed content. With `special_return`, the server's final chunk (token counts, timings)
+    is stored on `special_return.value` once the stream is exhausted.
+    """
+    try:
+        for chunk in response.iter_lines():
+            if chunk:
+                data = chunk.decode('utf-8')[6:]  # Remove 'data: ' prefix
+                if data == "[DONE]":
+                    break
+                chunk_data = json.loads(data)
+                if "choices" in chunk_data and chunk_data["choices"]:
+                    delta = chunk_data["choices"][0].get("delta", {})
+                    if "content" in delta:
+                        content = str(delta["content"])
+                        yield content
+                # `/completion` chunks carry content directly
+                elif chunk_data.get("content"):
+                    yield str(chunk_data["content"])
+                if special_return and chunk_data.get("stop"):
+                    special_return.value = chunk_data
+    finally:
+        # Hand the connection back to the pool
+        response.close()
+
+class TokenCache:
+    """
+    Memory-bounded LRU cache of tokenized strings, keyed by content and model.
+
+    Clears itself whenever the model being tokenized against changes.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.model = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(content: str, tokens: list) -> int:
+        return sys.getsizeof(content) + sys.getsizeof(tokens) + 28 * len(tokens)
+
+    def _check_model(self, model: str):
+        if model != self.model:
+            self._entries.clear()
+            self.size = 0
+            self.model = model
+
+    def get(self, model: str, content: str) -> list[int] | None:
+        with self._lock:
+            self._check_model(model)
+            entry = self._entries.get(content)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(content)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, model: str, content: str, tokens: list[int]):
+        cost = self._cost(content, tokens)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            self._check_model(model)
+            if content in self._entries:
+                self.size -= self._entries.pop(content)[1]
+            self._entries[content] = (tokens, cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self.size -= evicted_cost
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.size
+        }
+
+token_cache = TokenCache(int(settings.token_cache_mb * 1024 * 1024))
+
+def _local_tokenizer(model: Model):
+    if settings.local_tokenizer:
+        try:
+            return tokenizer.get(model[0])
+        except Exception as e:
+            log(LogType.warning, f"[API] Local tokenizer unavailable, falling back to llama-server ({e})")
+            settings.local_tokenizer = False
+    return None
+
+def tokenize(string: str, count: bool = False, model: Model = Model.core) -> list[int]:
+    local = _local_tokenizer(model)
+    if local:
+        model_key = model[0]
+    else:
+        host = load(model)
+        model_key = server.current_model
+    tokens = token_cache.get(model_key, string)
+    if tokens is None:
+        if local:
+            tokens = local.encode(string)
+        else:
+            response = transport.post(host + tokenize_endpoint, json={"content": string}).json()
+            tokens = response["tokens"]
+        token_cache.put(model_key, string, tokens)
+    if count:
+        return len(tokens)
+    # Callers may mutate the list
+    return list(tokens)
+
+def detokenize(tokens: list, return_list: bool = False, model: Model = Model.core) -> list[str]:
+    local = _local_tokenizer(model)
+    if local:
+        if return_list:
+            return local.pieces(tokens)
+        return local.decode(tokens)
+    host = load(model)
     if return_list:
         detok = []
         for tok in tokens:
-            response = requests.post(detokenize_endpoint, json={"tokens": [tok]}).json()
+            response = transport.post(host + detokenize_endpoint, json={"tokens": [tok]}).json()
             detok.append(response["content"])
         return detok
     else:
-        response = requests.post(detokenize_endpoint, json={"tokens": tokens}).json()
+        response = transport.post(host + detokenize_endpoint, json={"tokens": tokens}).json()
         return response["content"]
 
 def completion(
@@ -233,7 +367,7 @@ def completion(
     skip_formatting = False,
     **kwargs
 ):
-    load(model)
+    host = load(model)
     params = {}
     params["prompt"] = prompt if skip_formatting else _format_prompt(prompt)
     if kwargs:
@@ -251,10 +385,11 @@ def completion(
         
     if stream:
         params["stream"] = True
-        _response = requests.post(completion_endpoint, json=params, stream=True)
-        return _stream(_response)
+        _response = transport.post(host + completion_endpoint, json=params, stream=True)
+        return _stream(_response, special_return)
     else:
-        _response = requests.post(completion_endpoint, json=params).json()
+        _response = transport.post(host + completion_endpoint, json=params).json()
+        _track_usage(_response.get("tokens_evaluated", 0), _response.get("tokens_predicted", 0))
         if special_return:
             if special_return.return_type == "probability_trees":
                 if "completion_probabilities" in _response:
@@ -278,7 +413,7 @@ def completion(
                 content = json.loads(content)
             except Exception:
                 log(LogType.warning, f"[API] Error generating response! Trying again... ({traceback.format_exc()})")
-                completion(prompt, special_return, stream, **kwargs)
+                return completion(prompt, model=model, special_return=special_return, skip_formatting=skip_formatting, **kwargs)
         if special_return:
             return content, special
         else:
@@ -300,7 +435,7 @@ def response(
     
     `stream`: returns an iterable generator.
     """
-    load(model)
+    host = load(model)
     turn = [
         {
             "role": "system",
@@ -334,10 +469,11 @@ def response(
         
     if stream:
         params["stream"] = True
-        _response = requests.post(chat_endpoint, json=params, stream=True)
-        return _stream(_response)
+        _response = transport.post(host + chat_endpoint, json=params, stream=True)
+        return _stream(_response, special_return)
     else:
-        _response = requests.post(chat_endpoint, json=params).json()
+        _response = transport.post(host + chat_endpoint, json=params).json()
+        _track_usage(_response.get("usage", {}).get("prompt_tokens", 0), _response.get("usage", {}).get("completion_tokens", 0))
         if special_return:
             if special_return.return_type == "probability_trees":
                 if "completion_probabilities" in _response:
@@ -370,6 +506,94 @@ def response(
             return content
 
 
+async def completion_async(prompt: str, model: Model = Model.core, special_return: SpecialReturn = None, skip_formatting = False, **kwargs):
+    """
+    Non-blocking `completion`. Runs on a worker thread over the shared connection pool.
+    """
+    return await asyncio.to_thread(completion, prompt, model=model, special_return=special_return, skip_formatting=skip_formatting, **kwargs)
+
+async def response_async(system: str, prompt: str, model: Model = Model.core, history: list = [], special_return: SpecialReturn = None, **kwargs):
+    """
+    Non-blocking `response`.
+    """
+    return await asyncio.to_thread(response, system, prompt, model=model, history=history, special_return=special_return, **kwargs)
+
+async def tokenize_async(string: str, count: bool = False, model: Model = Model.core):
+    return await asyncio.to_thread(tokenize, string, count, model)
+
+async def _aiter_thread(generator_fn, *args, **kwargs) -> AsyncGenerator[str, None]:
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for chunk in generator_fn(*args, **kwargs):
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    producer = loop.run_in_executor(None, produce)
+    while True:
+        chunk = await queue.get()
+        if chunk is done:
+            break
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
+    await producer
+
+def completion_stream_async(prompt: str, model: Model = Model.core, skip_formatting = False, **kwargs) -> AsyncGenerator[str, None]:
+    """
+    Async generator over a streamed `completion`.
+    """
+    return _aiter_thread(completion, prompt, model=model, stream=True, skip_formatting=skip_formatting, **kwargs)
+
+def response_stream_async(system: str, prompt: str, model: Model = Model.core, history: list = [], **kwargs) -> AsyncGenerator[str, None]:
+    """
+    Async generator over a streamed `response`.
+    """
+    return _aiter_thread(response, system, prompt, model=model, history=history, stream=True, **kwargs)
+
+async def gather(tasks: Iterable[Awaitable], limit: int = None) -> list:
+    """
+    Await `tasks` concurrently, at most `limit` at a time (defaults to `LLAMA_PARALLEL` server slots).
+
+    Results are returned in order.
+    """
+    semaphore = asyncio.Semaphore(limit or settings.llama_parallel)
+
+    async def bounded(task):
+        async with semaphore:
+            return await task
+
+    return await asyncio.gather(*[bounded(task) for task in tasks])
+
+def _slot_action(action: str, filename: str, slot_id: int, model: Model) -> dict | None:
+    host = load(model)
+    try:
+        _response = transport.post(f"{host}{slots_endpoint}/{slot_id}?action={action}", json={"filename": filename})
+        if _response.status_code != 200:
+            raise Exception(_response.text)
+        return _response.json()
+    except Exception as e:
+        log(LogType.warning, f"[API] Could not {action} slot {slot_id} ({e})")
+        return None
+
+def save_slot(filename: str, slot_id: int = 0, model: Model = Model.core) -> dict | None:
+    """
+    Save a slot's KV cache to `filename` inside the server's slot save path.
+    """
+    return _slot_action("save", filename, slot_id, model)
+
+def restore_slot(filename: str, slot_id: int = 0, model: Model = Model.core) -> dict | None:
+    """
+    Restore a slot's KV cache previously saved with `save_slot`.
+    """
+    return _slot_action("restore", filename, slot_id, model)
+
 def append_to_history(history: list, role: str, content: str):
     history.append({"role": role, "content": content})
 
@@ -395,5 +619,5 @@ def get_history(history: list, as_string: bool = False):
 #        "min_p": kwargs.get("min_p", 0.5),
 #        **kwargs
 #    }
-#    response = requests.post(infill_endpoint, json=params).json()
+#    response = transport.post(infill_endpoint, json=params).json()
     
\ No newline at end of file
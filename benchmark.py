@@ -0,0 +1,413 @@
+"""
+Performance benchmarks. Run with `python benchmark.py <name> [options]`.
+"""
+import argparse
+from ast import literal_eval
+import asyncio
+import time
+import settings
+import server
+import api
+from server import Model
+from utils import log, LogType
+
+BENCHMARKS = {}
+
+def benchmark(f):
+    BENCHMARKS[f.__name__.removeprefix("bench_")] = f
+    return f
+
+def _report(title: str, rows: list[dict]):
+    log(LogType.system, f"[Benchmark] {title}")
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    widths = {k: max(len(k), *(len(str(row[k])) for row in rows)) for k in keys}
+    print("  ".join(k.ljust(widths[k]) for k in keys))
+    for row in rows:
+        print("  ".join(str(row[k]).ljust(widths[k]) for k in keys))
+
+@benchmark
+def bench_parallel(requests: int = 16, n_predict: int = 64, max_slots: int = 4):
+    """
+    Completion throughput for 1..`max_slots` llama-server parallel slots.
+    """
+    prompt = "Write a short paragraph about llamas:\n"
+    rows = []
+    slots = 1
+    while slots <= max_slots:
+        settings.llama_parallel = slots
+        server.close()
+        server.load(Model.core)
+
+        async def run():
+            tasks = [
+                api.completion_async(prompt, special_return=api.SpecialReturn.completion_tokens(), max_tokens=n_predict, seed=i, cache_prompt=True)
+                for i in range(requests)
+            ]
+            return await api.gather(tasks, limit=slots)
+
+        start = time.perf_counter()
+        results = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        tokens = sum(special for _, special in results)
+        rows.append({
+            "slots": slots,
+            "requests": requests,
+            "seconds": round(elapsed, 2),
+            "req/s": round(requests / elapsed, 2),
+            "tok/s": round(tokens / elapsed, 1)
+        })
+        slots *= 2
+    _report(f"Parallel completions ({n_predict} tokens each)", rows)
+    return rows
+
+@benchmark
+def bench_questions(q_count: int = 5, runs: int = 3, query: str = "How do bees decide where to build a new hive?"):
+    """
+    Latency and token usage of each `semantics.generate_questions` mode.
+    """
+    import semantics
+    server.load(Model.instruct)
+    rows = []
+    for mode in ["sequential", "single", "parallel"]:
+        api.reset_usage()
+        start = time.perf_counter()
+        for _ in range(runs):
+            semantics.generate_questions(query, q_count=q_count, mode=mode)
+        elapsed = (time.perf_counter() - start) / runs
+        rows.append({
+            "mode": mode,
+            "latency (s)": round(elapsed, 2),
+            "calls": api.usage["requests"] // runs,
+            "prompt tokens": api.usage["prompt_tokens"] // runs,
+            "completion tokens": api.usage["completion_tokens"] // runs
+        })
+    _report(f"generate_questions (q_count={q_count}, {runs} runs, LLAMA_PARALLEL={settings.llama_parallel})", rows)
+    return rows
+
+def _bench_persona(name: str):
+    """Scratch persona folder for memory benchmarks, removed afterwards."""
+    import shutil
+    from utils import get_dir
+    path = get_dir(f"personas/{name}")
+    shutil.rmtree(path, ignore_errors=True)
+    return path
+
+@benchmark
+def bench_store_memories(sizes: list = [1, 100, 10000], legacy_max: int = 100):
+    """
+    `InternalMemory.add` throughput, batched vs. the old one-call-per-entry loop.
+    """
+    import shutil
+    from memory import InternalMemory
+    # The synthetic entries are near-duplicates of each other
+    settings.memory_dedup = "off"
+    rows = []
+    for size in sizes:
+        entries = [f"Benchmark memory #{i}: the user mentioned liking topic {i % 97}." for i in range(size)]
+        path = _bench_persona("_benchmark")
+        try:
+            memory = InternalMemory("_benchmark")
+            start = time.perf_counter()
+            memory.add(entries, "user")
+            memory.flush()
+            batched = time.perf_counter() - start
+
+            legacy = None
+            if size <= legacy_max:
+                start = time.perf_counter()
+                for entry in entries:
+                    shard = memory.shard("user")
+                    shard.add(ids=[str(shard.count() + 1_000_000)], documents=[entry], metadatas=[{"source": "user"}])
+                legacy = time.perf_counter() - start
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+        rows.append({
+            "entries": size,
+            "batched (s)": round(batched, 3),
+            "batched (entries/s)": round(size / batched, 1),
+            "per-entry (entries/s)": round(size / legacy, 1) if legacy else "-"
+        })
+    _report("store_memories throughput", rows)
+    return rows
+
+@benchmark
+def bench_query_memories(entries: int = 1000, query_counts: list = [1, 5, 10, 20], runs: int = 5):
+    """
+    `InternalMemory.query` latency for batched multi-query vs. one query call per query.
+    """
+    import shutil
+    from memory import InternalMemory, _merge_results, MAX_PER_QUERY
+    settings.memory_dedup = "off"
+    path = _bench_persona("_benchmark")
+    rows = []
+    try:
+        memory = InternalMemory("_benchmark")
+        memory.add([f"Benchmark memory #{i}: the user mentioned liking topic {i % 97}." for i in range(entries)], "user")
+        memory.flush()
+        for count in query_counts:
+            queries = [f"What does the user think about topic {q * 7 % 97}?" for q in range(count)]
+            start = time.perf_counter()
+            for _ in range(runs):
+                memory.query(queries, "user")
+            batched = (time.perf_counter() - start) / runs
+
+            start = time.perf_counter()
+            for _ in range(runs):
+                for query in queries:
+                    _merge_results(memory.shard("user").query(query_texts=[query], n_results=MAX_PER_QUERY))
+            looped = (time.perf_counter() - start) / runs
+            rows.append({
+                "queries": count,
+                "batched (ms)": round(batched * 1000, 1),
+                "per-query (ms)": round(looped * 1000, 1),
+                "speedup": round(looped / batched, 2)
+            })
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    _report(f"query latency ({entries} entries)", rows)
+    return rows
+
+EMBEDDING_QUERIES = [
+    "What does the user do for a living?",
+    "Which foods does the user dislike?",
+    "When is the user's birthday?",
+    "What programming languages do I know?",
+    "How did the last conversation about music end?",
+    "What is the capital of Australia?",
+    "Why do leaves change colour in autumn?",
+    "Where did the user go on holiday?"
+]
+
+EMBEDDING_CORPUS = [
+    "The user works as a nurse on night shifts at the city hospital.",
+    "The user can't stand mushrooms or olives.",
+    "The user's birthday is on the 14th of March.",
+    "I can write Python and some Rust, and I'm learning Haskell.",
+    "We talked about jazz records and agreed to share playlists next time.",
+    "Canberra is the capital city of Australia, not Sydney.",
+    "Leaves change colour when chlorophyll breaks down and other pigments show.",
+    "The user spent two weeks hiking in Norway last summer.",
+    "The user has a cat named Miso.",
+    "I prefer short answers when the user is in a hurry.",
+    "The user's favourite band is Radiohead.",
+    "Mount Everest is the highest mountain above sea level.",
+    "The user is allergic to penicillin.",
+    "I once mixed up the user's sister's name, which is Clara.",
+    "Water boils at lower temperatures at high altitude.",
+    "The user plays chess online most evenings."
+]
+
+@benchmark
+def bench_embedding_backends(embedding: str = "all-distilroberta-v1", device: str = "cpu", runs: int = 3, k: int = 5):
+    """
+    Latency and accuracy of each embedding backend. Accuracy is measured against the torch model on a fixed
+    query set: mean cosine similarity of the vectors and overlap of the top-`k` retrieved memories.
+    """
+    import numpy as np
+    from memory import Backend, create_embedding_function
+
+    def normalized(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    texts = EMBEDDING_QUERIES + EMBEDDING_CORPUS
+    rows = []
+    reference = None
+    for backend in [Backend.torch, Backend.onnx, Backend.onnx_int8]:
+        start = time.perf_counter()
+        function = create_embedding_function(embedding, device, backend)
+        load_time = time.perf_counter() - start
+        function(texts[:1])
+        start = time.perf_counter()
+        for _ in range(runs):
+            vectors = normalized(function(texts))
+        elapsed = (time.perf_counter() - start) / runs
+
+        queries, corpus = vectors[:len(EMBEDDING_QUERIES)], vectors[len(EMBEDDING_QUERIES):]
+        top = np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+        if reference is None:
+            reference = (vectors, top)
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(top, reference[1])])
+        rows.append({
+            "backend": backend,
+            "load (s)": round(load_time, 2),
+            "ms/text": round(elapsed * 1000 / len(texts), 2),
+            "cosine vs torch": round(float(np.mean(np.sum(vectors * reference[0], axis=1))), 4),
+            f"top-{k} overlap": round(float(overlap), 3)
+        })
+    _report(f"Embedding backends ({embedding}, {device}, {len(texts)} texts)", rows)
+    return rows
+
+@benchmark
+def bench_recall(runs: int = 5):
+    """
+    Keyword-style recall and latency of `InternalMemory.query` with vector-only vs. hybrid retrieval.
+    """
+    import shutil
+    from memory import InternalMemory
+    # Each query names a detail of exactly one corpus entry
+    keyword_queries = {
+        "Miso": 8,
+        "penicillin": 12,
+        "Clara": 13,
+        "Canberra": 5,
+        "Radiohead": 10,
+        "chess": 15,
+        "14th of March": 2,
+        "Norway hiking": 7
+    }
+    settings.memory_dedup = "off"
+    path = _bench_persona("_benchmark")
+    rows = []
+    try:
+        memory = InternalMemory("_benchmark")
+        memory.add(EMBEDDING_CORPUS, "user")
+        memory.flush()
+        for mode in ["vector", "hybrid"]:
+            settings.memory_retrieval = mode
+            found = 0
+            start = time.perf_counter()
+            for _ in range(runs):
+                found = sum(
+                    EMBEDDING_CORPUS[answer] in memory.query([query], "user").split("\n")[0]
+                    for query, answer in keyword_queries.items()
+                )
+            elapsed = (time.perf_counter() - start) / (runs * len(keyword_queries))
+            rows.append({
+                "mode": mode,
+                "top-1 recall": round(found / len(keyword_queries), 3),
+                "latency (ms)": round(elapsed * 1000, 2)
+            })
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    _report(f"Keyword recall ({len(keyword_queries)} queries, {len(EMBEDDING_CORPUS)} memories)", rows)
+    return rows
+
+@benchmark
+def bench_vector_backends(sizes: list = [1000, 10000, 100000], dim: int = 768, queries: int = 20, k: int = 5):
+    """
+    Insert throughput, filtered top-`k` query latency and recall (vs. exact search) of each memory backend,
+    using random embeddings so no model is needed.
+    """
+    import shutil
+    import numpy as np
+    from memory import _create_client, _get_collection
+    rng = np.random.default_rng(0)
+    rows = []
+    for size in sizes:
+        vectors = rng.standard_normal((size, dim), dtype=np.float32)
+        sources = [["user", "self", "world_knowledge"][i % 3] for i in range(size)]
+        probes = rng.standard_normal((queries, dim), dtype=np.float32)
+        # Exact answers for recall
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        user_rows = np.array([i for i, source in enumerate(sources) if source == "user"])
+        similarity = (probes / np.linalg.norm(probes, axis=1, keepdims=True)) @ normalized[user_rows].T
+        exact = [set(str(user_rows[i]) for i in np.argsort(-row)[:k]) for row in similarity]
+
+        for backend in ["chroma", "numpy"]:
+            settings.memory_backend = backend
+            path = _bench_persona("_benchmark")
+            try:
+                client = _create_client(path)
+                collection = _get_collection(client, "index", None)
+                ids = [str(i) for i in range(size)]
+                batch = getattr(client, "max_batch_size", 5000)
+                start = time.perf_counter()
+                for i in range(0, size, batch):
+                    collection.add(
+                        ids=ids[i:i + batch],
+                        embeddings=vectors[i:i + batch].tolist(),
+                        documents=ids[i:i + batch],
+                        metadatas=[{"source": source} for source in sources[i:i + batch]]
+                    )
+                insert = time.perf_counter() - start
+
+                start = time.perf_counter()
+                results = [
+                    collection.query(query_embeddings=[probe.tolist()], n_results=k, where={"source": {"$eq": "user"}})["ids"][0]
+                    for probe in probes
+                ]
+                query = (time.perf_counter() - start) / queries
+                recall = np.mean([len(set(result) & truth) / k for result, truth in zip(results, exact)])
+            finally:
+                del client
+                shutil.rmtree(path, ignore_errors=True)
+            rows.append({
+                "entries": size,
+                "backend": backend,
+                "insert (entries/s)": round(size / insert, 1),
+                "query (ms)": round(query * 1000, 2),
+                f"recall@{k}": round(float(recall), 3)
+            })
+    _report(f"Vector backends (dim={dim}, {queries} filtered queries)", rows)
+    return rows
+
+@benchmark
+def bench_sharding(user: int = 1000, world_knowledge: list = [1000, 10000, 100000], dim: int = 768, queries: int = 20, k: int = 5):
+    """
+    "user" query latency with one filtered collection vs. one collection per source, as "world_knowledge" grows.
+    Uses random embeddings on the configured `MEMORY_BACKEND`.
+    """
+    import shutil
+    import numpy as np
+    from memory import _create_client, _get_collection, SHARD_PREFIX
+    rng = np.random.default_rng(0)
+    probes = rng.standard_normal((queries, dim), dtype=np.float32).tolist()
+    rows = []
+    for size in world_knowledge:
+        entries = {"user": user, "world_knowledge": size}
+        path = _bench_persona("_benchmark")
+        try:
+            client = _create_client(path)
+            single = _get_collection(client, "index", None)
+            shards = {source: _get_collection(client, f"{SHARD_PREFIX}{source}", None) for source in entries}
+            batch = getattr(client, "max_batch_size", 5000)
+            next_id = 0
+            for source, count in entries.items():
+                for start in range(0, count, batch):
+                    n = min(batch, count - start)
+                    ids = [str(next_id + i) for i in range(n)]
+                    next_id += n
+                    vectors = rng.standard_normal((n, dim), dtype=np.float32).tolist()
+                    metadatas = [{"source": source}] * n
+                    for collection in (single, shards[source]):
+                        collection.add(ids=ids, embeddings=vectors, documents=ids, metadatas=metadatas)
+
+            start = time.perf_counter()
+            for probe in probes:
+                single.query(query_embeddings=[probe], n_results=k, where={"source": {"$eq": "user"}})
+            filtered = (time.perf_counter() - start) / queries
+            start = time.perf_counter()
+            for probe in probes:
+                shards["user"].query(query_embeddings=[probe], n_results=k)
+            sharded = (time.perf_counter() - start) / queries
+        finally:
+            del client
+            shutil.rmtree(path, ignore_errors=True)
+        rows.append({
+            "world_knowledge": size,
+            "filtered (ms)": round(filtered * 1000, 2),
+            "sharded (ms)": round(sharded * 1000, 2),
+            "speedup": round(filtered / sharded, 2)
+        })
+    _report(f"'user' queries ({user} entries, MEMORY_BACKEND={settings.memory_backend})", rows)
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MIST benchmarks")
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("options", nargs="*", help="key=value overrides for the benchmark's arguments")
+    args = parser.parse_args()
+    options = {}
+    for option in args.options:
+        key, _, value = option.partition("=")
+        try:
+            options[key] = literal_eval(value)
+        except (ValueError, SyntaxError):
+            options[key] = value
+    try:
+        BENCHMARKS[args.name](**options)
+    finally:
+        server.close()
@@ -1,11 +1,15 @@
 import server
+import transport
+import api
+import memory
 from core import Session
 from functions import Toolkit
 from persona import Persona
 import traceback
-from utils import log, LogType, _boot_padding, _shuffle_acronym
+from utils import log, LogType, _boot_padding, _shuffle_acronym, timed
 from settings import llama_update, disable_splash, override_responses
 import sys
+import os
 if __name__ == "__main__":
     try:
         if not disable_splash:
@@ -17,14 +21,20 @@ if __name__ == "__main__":
             log(LogType.boot_sequence,"                                                  ")
             log(LogType.boot_sequence, _boot_padding(_shuffle_acronym()))
             log(LogType.boot_sequence, _boot_padding(""))
-        if llama_update():
-            server.update()
+        boot_timings = {}
+        with timed("update", boot_timings):
+            if llama_update():
+                server.update()
         # Load a persona. Defaults to `DEFAULT_PERSONA` in `.env`
-        persona = Persona()
+        with timed("persona", boot_timings):
+            persona = Persona()
         # Create toolkit with all registered functions
-        toolkit = Toolkit()
+        with timed("toolkit", boot_timings):
+            toolkit = Toolkit()
         # Start persona session, extend toolkit with core funcs.
-        session = Session(persona=persona, toolkit=toolkit)
+        with timed("session", boot_timings):
+            session = Session(persona=persona, toolkit=toolkit)
+        log(LogType.debug, "[Boot] " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in boot_timings.items()))
         # Init
         session.add_event("Self", f"Boot sequence complete! Last boot date: {persona.config['last_boot']}.")
         persona.set_last_boot()
@@ -35,4 +45,30 @@ if __name__ == "__main__":
         tb = traceback.format_exc()
         log(LogType.error, tb)
     finally:
-        server.close()
\ No newline at end of file
+        try:
+            pool = transport.stats()
+            log(LogType.debug, f"[Server] Connection reuse: {pool['reuse_rate']:.0%} ({pool['requests']} requests, {pool['connections']} connections)")
+            tokens = api.token_cache.stats()
+            log(LogType.debug, f"[API] Token cache: {tokens['hit_rate']:.0%} hit rate ({tokens['hits']} hits, {tokens['misses']} misses)")
+            for name, store in [("Internal", Session.__dict__.get("internal_memory")), ("External", Session.__dict__.get("external_memory"))]:
+                if isinstance(store, memory.MemoryLoader) and store.load_time is not None:
+                    log(LogType.debug, f"[Memory] {name} memory loaded in {store.load_time:.2f}s")
+            internal_memory = Session.__dict__.get("internal_memory")
+            if internal_memory is not None and (not isinstance(internal_memory, memory.MemoryLoader) or internal_memory.ready()):
+                suppressed = internal_memory.suppressed
+                log(LogType.debug, f"[Memory] Duplicate writes suppressed: {suppressed['skipped']} skipped, {suppressed['merged']} merged")
+                consolidated = internal_memory.consolidated
+                log(LogType.debug, f"[Memory] Consolidated {consolidated['entries']} entries into {consolidated['clusters']} memories")
+            for name, stats in memory.embedding_stats().items():
+                log(LogType.debug, f"[Memory] Embedding cache ({name}): {stats['hit_rate']:.0%} hit rate ({stats['hits']} hits, {stats['misses']} misses)")
+            log(LogType.debug, f"[Session] KV cache hit ratio: {Session.cache_hit_ratio():.0%}")
+            if Session.prefetcher:
+                prefetch = Session.prefetcher.stats
+                log(LogType.debug, f"[Memory] Prefetch: {Session.prefetcher.hit_rate():.0%} hit rate ({prefetch['hits']} hits, {prefetch['misses']} misses), {prefetch['saved']:.2f}s saved")
+            for model_path, stats in server.pool_stats.items():
+                log(LogType.debug, f"[Server] {os.path.basename(model_path)}: {stats['loads']} loads, {stats['evictions']} evictions, last load {stats['load_time']}s")
+        except Exception:
+            log(LogType.error, traceback.format_exc())
+        finally:
+            # Always stop the llama-server processes, even if reporting failed
+            server.close()
@@ -1,15 +1,66 @@
-from api import make_schema, SchemaValue, completion, SpecialReturn, tokenize, _format_prompt
+from api import make_schema, SchemaValue, completion, SpecialReturn, tokenize, _format_prompt, save_slot, restore_slot
 from functions import Toolkit, execute_function
 from utils import log, LogType, Time, get_dir, rand_seed, unsnake, capfirst
 from persona import Persona
 from ast import literal_eval
-from memory import InternalMemory, ExternalMemory
+from memory import InternalMemory, ExternalMemory, MemoryPrefetcher, load_store
 import session_manager
 import settings
+import server
 import json
 import sys
+import os
+import hashlib
+import time
+from jsonstream import JSONStreamParser
+
+class HistoryBuffer:
+    """
+    Append-only serialized view of `Session.history`.
+
+    Only newly appended cycles are serialized and evicted cycles are sliced off the front,
+    so syncing costs scale with the change rather than the history length.
+    """
+    def __init__(self):
+        self._entries = []
+        self._lengths = []
+        self.text = ""
+
+    def _reset(self):
+        self._entries = []
+        self._lengths = []
+        self.text = ""
+
+    def sync(self, history: list) -> str:
+        if not history:
+            self._reset()
+            return self.text
+        # Find where the current history starts within the buffer
+        offset = next((i for i, entry in enumerate(self._entries) if entry is history[0]), None)
+        kept = len(self._entries) - offset if offset is not None else 0
+        if offset is None or kept > len(history) or any(a is not b for a, b in zip(self._entries[offset:], history)):
+            self._reset()
+            offset, kept = 0, 0
+        if offset:
+            # Each entry is followed by its ", " separator
+            cut = sum(self._lengths[:offset]) + 2 * offset
+            self.text = self.text[cut:]
+            del self._entries[:offset]
+            del self._lengths[:offset]
+        for entry in history[kept:]:
+            serialized = json.dumps(entry)
+            self.text = f"{self.text}, {serialized}" if self.text else serialized
+            self._entries.append(entry)
+            self._lengths.append(len(serialized))
+        return self.text
 
 class Session:
+    kv_cache = {"reused": 0, "prompt": 0}
+    slot_file = None
+    prefetcher = None
+    streaming = False
+    save_slot_on_exit = False
+
     def __init__(self, persona: Persona, toolkit: Toolkit = None):
         self.profile = persona.get_profile()
         self.name = persona.get_profile('name')
@@ -25,11 +76,16 @@ class Session:
         Session.history = []
         Session.cycle_events = []
         Session.session_summary = []
-        Session.internal_memory = InternalMemory(self.name)
-        Session.external_memory = ExternalMemory(self.name)
+        Session.internal_memory = load_store(InternalMemory, self.name)
+        Session.external_memory = load_store(ExternalMemory, self.name)
+        Session.prefetcher = MemoryPrefetcher(Session.internal_memory, ["user", "self", "world_knowledge"]) if settings.memory_prefetch else None
         Session.persona_path = get_dir(f"personas/{self.name}")
         self._is_primed = False
         self._persona_cycles_path = get_dir(f"personas/{self.name}/cycles")
+        self._history_buffer = HistoryBuffer()
+        self._dispatched = 0
+        self._system_key = None
+        self._system_text = ""
         
         if toolkit:
             self.toolkit = toolkit
@@ -78,10 +134,13 @@ class Session:
         try:
             Session.history, summaries = session_manager.load_history(self.persona_path, self.working_ctx)
             if Session.history and summaries:
-                self.session_summary = summaries
+                Session.session_summary = summaries
         except:
             pass
         
+        if settings.llama_slot_persistence:
+            self._restore_slot()
+
         if self.priming_schema is None:
             if self.override_responses:
                 log(LogType.warning, "No priming schema! You may need to override the first few responses.")
@@ -97,19 +156,67 @@ class Session:
                 "content": content
             }
         )
+        if source == "User" and cls.prefetcher:
+            cls.prefetcher.prefetch(content)
 
     @classmethod
     def quit(cls):
         if cls.session_summary != []:
             cls.internal_memory.add(cls.session_summary, "self")
+        # Anything still queued after this is replayed from the journal next boot
+        cls.internal_memory.flush(timeout=60)
+        if settings.llama_slot_persistence:
+            if cls.streaming:
+                # Slot 0 is still generating, saved once the stream ends
+                cls.save_slot_on_exit = True
+            else:
+                cls._save_slot()
         cls.persona.set_session_count()
         cls.exit = True
 
-    def _prompt(self):
+    def _slot_prefix(self):
+        model = os.path.splitext(os.path.basename(settings.core_model))[0]
+        return f"{self.name}-{model}-"
+
+    def _restore_slot(self):
+        """
+        Reload the KV cache saved by a previous session of this persona, model and prompt prefix.
+        """
+        instructions = _format_prompt(self._instructions(), format_codeblocks=False)
+        prefix_hash = hashlib.sha256(instructions.encode("utf-8")).hexdigest()[:16]
+        Session.slot_file = f"{self._slot_prefix()}{prefix_hash}.bin"
+        if os.path.isfile(get_dir("slots") / Session.slot_file):
+            if restore_slot(Session.slot_file):
+                log(LogType.system, f"[Session] Restored KV cache from {Session.slot_file}")
+        # Saves for an outdated prompt prefix can never be restored
+        for file in os.listdir(get_dir("slots")):
+            if file.startswith(self._slot_prefix()) and file != Session.slot_file:
+                os.remove(get_dir("slots") / file)
+
+    @classmethod
+    def _save_slot(cls):
+        if not cls.slot_file:
+            return
+        # Saving through an evicted core would respawn it and overwrite the snapshot with its empty slot
+        if not server.is_running(settings.core_model):
+            log(LogType.system, f"[Session] Core server isn't running, keeping {cls.slot_file} as is")
+            return
+        save_slot(cls.slot_file)
+
+    def _summary(self):
         if Session.session_summary:
-            summary = "<SUMMARY>\nYour summary of older cycles from this session:\n" + "\n".join([f"- \"{entry}\"" for entry in Session.session_summary]) + "\n</SUMMARY>\n"
+            return "<SUMMARY>\nYour summary of older cycles from this session:\n" + "\n".join([f"- \"{entry}\"" for entry in Session.session_summary]) + "\n</SUMMARY>\n"
         else:
-            summary = ""
+            return ""
+
+    def _prompt(self):
+        return f"""
+            {self._instructions()}
+            {self._summary()}
+            <ACTIVITY>
+        """
+
+    def _instructions(self):
         return f"""
             <bos>
             <INSTRUCTIONS>
@@ -154,16 +261,68 @@ class Session:
             - **If a function has no arguments, provide an empty `arguments` schema for the corresponding function.**
             </NOTES>
             </INSTRUCTIONS>
-            {summary}
-            <ACTIVITY>
         """
 
+    def _system_prompt(self):
+        """
+        Formatted system block, rebuilt only when the profile, toolkit or summary changes.
+
+        The `stable` layout caches the instructions on their own and appends the summary after them,
+        so the KV cache prefix only changes when cycles are evicted.
+        """
+        stable = settings.prompt_layout == "stable"
+        key = (self.profile, tuple(self.toolkit._names()), None if stable else tuple(Session.session_summary))
+        if key != self._system_key:
+            if stable:
+                self._system_text = _format_prompt(self._instructions(), format_codeblocks=False)
+            else:
+                self._system_text = _format_prompt(self._prompt(), format_codeblocks=False)
+            self._system_key = key
+        if stable:
+            return f"{self._system_text}\n{self._summary()}<ACTIVITY>"
+        return self._system_text
+
     def _ctx_limit(self):
         if self.session_tokens >= self.working_ctx:
             return True
         else:
             return False
 
+    def _eviction_target(self):
+        """
+        Token count to evict down to once the context limit is hit.
+
+        The `stable` layout evicts in large batches so the prompt prefix (and the server's KV cache) survives for longer.
+        """
+        if settings.prompt_layout == "stable":
+            return int(self.working_ctx * (1 - settings.prompt_eviction_ratio))
+        return self.working_ctx - 1
+
+    @classmethod
+    def _track_cache(cls, specials: dict):
+        timings = specials.get("timings", {})
+        if "cache_n" in timings:
+            reused = timings["cache_n"]
+            prompt = timings["cache_n"] + timings.get("prompt_n", 0)
+        elif "prompt_n" in timings:
+            # Older servers: everything not re-evaluated came from the cache
+            prompt = int(specials.get("tokens_evaluated", 0))
+            reused = max(prompt - timings["prompt_n"], 0)
+        else:
+            prompt = int(specials.get("tokens_evaluated", 0))
+            reused = min(int(specials.get("tokens_cached", 0)), prompt)
+        cls.kv_cache["reused"] += reused
+        cls.kv_cache["prompt"] += prompt
+
+    @classmethod
+    def cache_hit_ratio(cls):
+        """
+        Share of prompt tokens served from llama-server's KV cache this session.
+        """
+        if cls.kv_cache["prompt"]:
+            return round(cls.kv_cache["reused"] / cls.kv_cache["prompt"], 3)
+        return 0.0
+
     def _run(self, cycle_prompt):
         logit_bias = {"\\n": False}
         if settings.core_logit_bias:
@@ -191,17 +350,20 @@ class Session:
                 return tokens
             return []
 
+        streaming = settings.core_streaming and not self.override_responses
+
         while True:
-            if Session.history:
-                prompt = str(", ".join([json.dumps(entry) for entry in Session.history])) + ", " + cycle_prompt
+            history = self._history_buffer.sync(Session.history)
+            if history:
+                prompt = history + ", " + cycle_prompt
             else:
                 prompt = cycle_prompt
-            response, specials = completion(
-                prompt=_format_prompt(self._prompt(), format_codeblocks=False) + "\n```json\n{\"session\": " + prompt,
-                special_return=SpecialReturn.full(),
+            prompt = self._system_prompt() + "\n```json\n{\"session\": " + prompt
+            params = dict(
                 json_schema=schema,
                 skip_formatting=True,
                 cache_prompt=True,
+                id_slot=0,
                 temperature=settings.core_temperature,
                 top_p=settings.core_top_p,
                 repeat_last_n=512,
@@ -212,11 +374,20 @@ class Session:
                 presence_penalty=settings.core_presence_penalty
             )
 
-            total_tokens = int(specials["tokens_predicted"]) + int(specials["tokens_evaluated"])
+            response = None
+            if streaming:
+                response, specials = self._stream_response(prompt, params)
+                if response is None:
+                    log(LogType.warning, "[Session] Streamed response was not valid JSON! Trying again without streaming...")
+            if response is None:
+                self._dispatched = 0
+                response, specials = completion(prompt=prompt, special_return=SpecialReturn.full(), **params)
+                for k, v in response.items():
+                    v = json.dumps(v, ensure_ascii=False)
+                    log(LogType.think, f"{k.capitalize()}: {v}", with_prefix=False)
 
-            for k, v in response.items():
-                v = json.dumps(v, ensure_ascii=False)
-                log(LogType.think, f"{k.capitalize()}: {v}", with_prefix=False)
+            total_tokens = int(specials.get("tokens_predicted", 0)) + int(specials.get("tokens_evaluated", 0))
+            Session._track_cache(specials)
 
             if self.override_responses:
                 action = input("Press 'r' to regenerate, 'o' to override, any to continue:\n> ").casefold()
@@ -239,8 +410,71 @@ class Session:
                                 response[key] = new_value
 
             self.session_tokens = total_tokens
-            self.cycle_tokens[self.cycles] += int(specials["tokens_predicted"])
+            self.cycle_tokens[self.cycles] += int(specials.get("tokens_predicted", 0))
             return response
+
+    def _stream_response(self, prompt: str, params: dict):
+        """
+        Stream the cognitive response, logging each field and dispatching each function as soon as it closes.
+
+        Returns `(None, None)` if the streamed text isn't valid JSON and nothing was dispatched yet. Once a function
+        has run, its side effects can't be undone, so the fields parsed so far are kept instead of regenerating.
+        """
+        special = SpecialReturn.full()
+        parser = JSONStreamParser()
+        started = time.perf_counter()
+        timings = {}
+        response = None
+        fields = {}
+        dispatched = []
+        Session.streaming = True
+        try:
+            for chunk in completion(prompt=prompt, special_return=special, stream=True, **params):
+                timings.setdefault("first_token", time.perf_counter() - started)
+                for path, value in parser.feed(chunk):
+                    if path == ():
+                        response = value
+                    elif len(path) == 1:
+                        fields[path[0]] = value
+                        if path[0] != "functions":
+                            log(LogType.think, f"{path[0].capitalize()}: {json.dumps(value, ensure_ascii=False)}", with_prefix=False)
+                    elif len(path) == 2 and path[0] == "functions":
+                        timings.setdefault("first_action", time.perf_counter() - started)
+                        if isinstance(value, dict) and value.get("name") == "chat":
+                            timings.setdefault("first_chat", time.perf_counter() - started)
+                        log(LogType.think, f"Function: {json.dumps(value, ensure_ascii=False)}", with_prefix=False)
+                        self._execute(value)
+                        dispatched.append(value)
+                        self._dispatched += 1
+        finally:
+            Session.streaming = False
+            if Session.save_slot_on_exit:
+                Session.save_slot_on_exit = False
+                Session._save_slot()
+        timings["total"] = time.perf_counter() - started
+
+        if response is None:
+            try:
+                response = json.loads(parser.text())
+            except Exception:
+                if not dispatched:
+                    return None, None
+                log(LogType.warning, f"[Session] Streamed response was cut off after {len(dispatched)} functions, keeping what was parsed.")
+                empty = {"array": [], "object": {}}
+                response = {key: fields.get(key, empty.get(value.get("type"), "")) for key, value in self.schema["properties"].items()}
+                response["functions"] = dispatched
+        log(LogType.debug, "[Session] Stream timings: " + ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+        return response, special.value or {}
+
+    def _execute(self, function: dict):
+        func_name = function["name"]
+        try:
+            func_args = function["arguments"]
+        except:
+            func_args = {}
+        result = execute_function(func_name, **func_args)
+        if result != "None":
+            Session.add_event(f"{func_name} function", f"Function result: {result}")
             
     def parse(self, override_responses: bool = False):
         self.override_responses = override_responses
@@ -251,6 +485,7 @@ class Session:
         self.cycle_tokens[self.cycles] = tokenize(cycle_prompt, count=True)
         # Clear events
         Session.cycle_events = []
+        self._dispatched = 0
         if self._is_primed:
             response = self._run(cycle_prompt)
         else:
@@ -267,22 +502,16 @@ class Session:
 
         # Check if we're past ctx limit, remove as many cycles as needed to clear ctx window
         if self._ctx_limit():
-            while self._ctx_limit():
+            target = self._eviction_target()
+            while Session.history and self.session_tokens > target:
                 oldest = Session.history.pop(0)
                 cycle = list(oldest.keys())[0]
-                self.session_summary.append(oldest[cycle]["cognitive_response"]["cycle_summary"])
-                self.session_tokens -= self.cycle_tokens[int(cycle[6:])] # Remove `cycle_`
+                Session.session_summary.append(oldest[cycle]["cognitive_response"]["cycle_summary"])
+                self.session_tokens -= self.cycle_tokens.get(int(cycle[6:]), 0) # Remove `cycle_`
 
-        # And then we run funcs and append
-        for function in response["functions"]:
-            func_name = function["name"]
-            try:
-                func_args = function["arguments"]
-            except:
-                func_args = {}
-            result = execute_function(func_name, **func_args)
-            if result != "None":
-                Session.add_event(f"{func_name} function", f"Function result: {result}")
+        # And then we run funcs (skipping any already dispatched while streaming) and append
+        for function in response["functions"][self._dispatched:]:
+            self._execute(function)
 
         # Rebuild cycle schema, append/save, restart
         cycle = literal_eval(cycle_prompt + str(response) + "}}")
@@ -0,0 +1,292 @@
+"""
+Shared embedding daemon. Loads each embedding model once and serves every MIST process over a Unix socket.
+
+Run with `python embedding_service.py`, or let `EmbeddingClient` start it on first use.
+Requests arriving within `max_wait_ms` of each other are embedded together, up to `max_batch` texts.
+"""
+from chromadb.api.types import EmbeddingFunction, Documents, Embeddings
+from embeddings import _FileLock
+from utils import log, LogType, get_dir
+import numpy as np
+import subprocess
+import threading
+import argparse
+import socket
+import struct
+import queue
+import json
+import time
+import sys
+import os
+
+def default_socket_path() -> str:
+    return str(get_dir("embeddings") / "service.sock")
+
+def _start_lock(socket_path: str) -> _FileLock:
+    # Shared by every process starting or serving the daemon on this socket
+    return _FileLock(f"{socket_path}.lock")
+
+def _listening(socket_path: str) -> bool:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        conn.close()
+
+def _send(conn: socket.socket, payload: bytes):
+    conn.sendall(struct.pack("<I", len(payload)) + payload)
+
+def _receive_exactly(conn: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = conn.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _receive(conn: socket.socket) -> bytes:
+    size, = struct.unpack("<I", _receive_exactly(conn, 4))
+    return _receive_exactly(conn, size)
+
+class _Request:
+    def __init__(self, texts: list):
+        self.texts = texts
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+class EmbeddingServer:
+    """
+    Accepts connections on `socket_path` and routes each request to a per-model batching worker.
+
+    Protocol: every message is a little-endian uint32 length followed by the payload. A request is a JSON object
+    (`{"embedding", "device", "backend", "texts"}` or `{"op": "stats"}`), answered with a JSON header
+    (`{"count", "dim"}` or `{"error"}`) followed, on success, by the float32 vectors.
+    """
+    def __init__(self, socket_path: str = None, max_batch: int = 64, max_wait_ms: float = 5):
+        self.socket_path = socket_path or default_socket_path()
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.models = {}
+        self.queues = {}
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "clients": 0}
+        self._lock = threading.Lock()
+
+    def _queue(self, embedding: str, device: str, backend: str) -> queue.Queue:
+        key = (embedding, device, backend)
+        with self._lock:
+            if key not in self.queues:
+                self.queues[key] = queue.Queue()
+                threading.Thread(target=self._batch_worker, args=(key,), name=f"embed-{embedding}", daemon=True).start()
+            return self.queues[key]
+
+    def _batch_worker(self, key: tuple):
+        import memory
+        embedding, device, backend = key
+        requests = self.queues[key]
+        function = None
+        while True:
+            batch = [requests.get()]
+            size = len(batch[0].texts)
+            deadline = time.perf_counter() + self.max_wait
+            # Gather whatever else arrives before the deadline
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            try:
+                if function is None:
+                    # Loaded on the worker so a failure is reported to the waiting clients
+                    function = memory._get_embedding(embedding, device, backend)
+                    self.models[key] = function
+                    log(LogType.system, f"[Embeddings] Loaded {embedding} ({backend}).")
+                texts = [text for request in batch for text in request.texts]
+                vectors = np.asarray(function(texts), dtype=np.float32)
+                start = 0
+                for request in batch:
+                    request.vectors = vectors[start:start + len(request.texts)]
+                    start += len(request.texts)
+            except Exception as e:
+                for request in batch:
+                    request.error = str(e)
+            self.stats["batches"] += 1
+            for request in batch:
+                request.done.set()
+
+    def _handle(self, conn: socket.socket):
+        with conn:
+            with self._lock:
+                self.stats["clients"] += 1
+            try:
+                while True:
+                    message = json.loads(_receive(conn))
+                    if message.get("op") == "stats":
+                        _send(conn, json.dumps(self.status()).encode("utf-8"))
+                        continue
+                    request = _Request(message["texts"])
+                    with self._lock:
+                        self.stats["requests"] += 1
+                        self.stats["texts"] += len(request.texts)
+                    if request.texts:
+                        self._queue(message["embedding"], message.get("device"), message["backend"]).put(request)
+                        request.done.wait()
+                    else:
+                        request.vectors = np.zeros((0, 0), dtype=np.float32)
+                    if request.error:
+                        _send(conn, json.dumps({"error": request.error}).encode("utf-8"))
+                        continue
+                    _send(conn, json.dumps({"count": len(request.vectors), "dim": request.vectors.shape[1]}).encode("utf-8"))
+                    _send(conn, request.vectors.tobytes())
+            except ConnectionError:
+                pass
+            finally:
+                with self._lock:
+                    self.stats["clients"] -= 1
+
+    def status(self) -> dict:
+        cache = {}
+        for (embedding, _, backend), function in list(self.models.items()):
+            if hasattr(function, "stats"):
+                for key, value in function.stats().items():
+                    if isinstance(value, (int, float)) and key != "hit_rate":
+                        cache[key] = cache.get(key, 0) + value
+        lookups = cache.get("hits", 0) + cache.get("misses", 0)
+        return {
+            **self.stats,
+            "models": [f"{embedding}-{backend}" for embedding, _, backend in self.models],
+            "average_batch": round(self.stats["texts"] / self.stats["batches"], 1) if self.stats["batches"] else 0.0,
+            "hits": cache.get("hits", 0),
+            "misses": cache.get("misses", 0),
+            "hit_rate": round(cache.get("hits", 0) / lookups, 3) if lookups else 0.0
+        }
+
+    def serve(self):
+        with _start_lock(self.socket_path):
+            if _listening(self.socket_path):
+                log(LogType.system, f"[Embeddings] Already serving on {self.socket_path}, exiting.")
+                return
+            # Nothing answers, so any socket file left is stale
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(self.socket_path)
+            listener.listen(64)
+        log(LogType.system, f"[Embeddings] Serving on {self.socket_path}")
+        try:
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+class EmbeddingClient(EmbeddingFunction):
+    """
+    Drop-in chromadb embedding function backed by the shared embedding daemon, starting it if needed.
+    One connection per thread.
+    """
+    def __init__(self, embedding: str, device: str = None, backend: str = "torch", socket_path: str = None, start_timeout: float = 120):
+        self.embedding = embedding
+        self.device = device
+        self.backend = backend
+        self.socket_path = socket_path or default_socket_path()
+        self.start_timeout = start_timeout
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.socket_path)
+        return conn
+
+    def _start_daemon(self):
+        with self._start_lock:
+            # Released before waiting, the daemon takes it too. A daemon started twice exits once it sees the other.
+            with _start_lock(self.socket_path):
+                if _listening(self.socket_path):
+                    return
+                log(LogType.system, "[Embeddings] Starting shared embedding service...")
+                with open(get_dir("logs") / "embedding-service.log", "a") as log_file:
+                    subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__), "--socket", self.socket_path],
+                        stdout=log_file,
+                        stderr=subprocess.STDOUT,
+                        # Outlives the process that started it, so other personas can keep using it
+                        start_new_session=True
+                    )
+            deadline = time.perf_counter() + self.start_timeout
+            while time.perf_counter() < deadline:
+                try:
+                    self._connect().close()
+                    return
+                except OSError:
+                    time.sleep(0.2)
+            raise RuntimeError("Embedding service didn't start, see logs/embedding-service.log")
+
+    def _connection(self) -> socket.socket:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                conn = self._connect()
+            except OSError:
+                self._start_daemon()
+                conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _request(self, message: dict, binary: bool = True):
+        # Retry once on a fresh connection, e.g: after the service restarted
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                _send(conn, json.dumps(message).encode("utf-8"))
+                header = json.loads(_receive(conn))
+                if not binary or "error" in header:
+                    return header, None
+                return header, _receive(conn)
+            except (ConnectionError, OSError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if not input:
+            return []
+        header, payload = self._request({"embedding": self.embedding, "device": self.device, "backend": self.backend, "texts": list(input)})
+        if "error" in header:
+            raise RuntimeError(f"Embedding service error: {header['error']}")
+        return np.frombuffer(payload, dtype=np.float32).reshape(header["count"], header["dim"]).tolist()
+
+    def stats(self) -> dict:
+        """
+        Service-wide stats, including its embedding cache.
+        """
+        try:
+            status, _ = self._request({"op": "stats"}, binary=False)
+        except (ConnectionError, OSError):
+            status = {}
+        return {"hits": 0, "misses": 0, "hit_rate": 0.0, **status}
+
+if __name__ == "__main__":
+    import settings
+    parser = argparse.ArgumentParser(description="MIST shared embedding service")
+    parser.add_argument("--socket", default=None, help="Unix socket path (default: embeddings/service.sock)")
+    parser.add_argument("--max-batch", type=int, default=64, help="Most texts embedded in one forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=5, help="How long to wait for more requests to batch")
+    args = parser.parse_args()
+    # The service itself always embeds in-process
+    settings.embedding_service = False
+    EmbeddingServer(args.socket, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms).serve()
@@ -0,0 +1,318 @@
+from chromadb.api.types import EmbeddingFunction, Documents, Embeddings
+from utils import get_dir, write_json_atomic
+import numpy as np
+import threading
+import hashlib
+import atexit
+import time
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+class _FileLock:
+    """
+    Exclusive lock shared between processes, held for the duration of a `with` block.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """
+    Content-addressed, persistent cache around any chromadb embedding function.
+
+    Vectors are stored as float16 in a memory-mapped file per embedding model, with LRU eviction once
+    `max_mb` is reached. Every process using the same model shares the files: slots are only allocated under a
+    file lock, and each slot records the hash of the text it holds, which lookups check before trusting it.
+    """
+    def __init__(self, function: EmbeddingFunction, name: str, max_mb: int = 128):
+        self.function = function
+        self.name = name
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.path = get_dir(f"embeddings/cache/{name}")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key: slot, a local hint that's always checked against the shared slot table
+        self._slots = {}
+        self._writes = 0
+        self._vectors = None
+        self._header = None
+        self._table = None
+        self.dim = None
+        self.capacity = 0
+        with self._file_lock():
+            self._attach()
+        atexit.register(self.save)
+
+    def _file_lock(self) -> _FileLock:
+        return _FileLock(os.path.join(self.path, "lock"))
+
+    def _meta_path(self):
+        return os.path.join(self.path, "cache.json")
+
+    def _vectors_path(self):
+        return os.path.join(self.path, "vectors.f16")
+
+    def _table_path(self):
+        return os.path.join(self.path, "slots.u64")
+
+    def _open(self, dim: int, capacity: int, mode: str):
+        self.dim = dim
+        self.capacity = capacity
+        self._vectors = np.memmap(self._vectors_path(), dtype=np.float16, mode=mode, shape=(capacity, dim))
+        # Row 0 counts writes, so other processes can tell their hints are stale. Then one row per slot:
+        # the two halves of the key (all zero when free) and the last time it was used.
+        table = np.memmap(self._table_path(), dtype=np.uint64, mode=mode, shape=(capacity + 1, 3))
+        self._header = table[0]
+        self._table = table[1:]
+
+    def _attach(self, dim: int = None):
+        """
+        Open the shared cache files, creating them for `dim` if they don't exist yet. Call with the file lock held.
+        """
+        try:
+            with open(self._meta_path(), "r", encoding="utf-8") as file:
+                meta = json.load(file)
+            # Another process may have sized it differently, its capacity wins
+            expected = meta["capacity"] * meta["dim"] * 2
+            if os.path.getsize(self._vectors_path()) != expected or os.path.getsize(self._table_path()) != (meta["capacity"] + 1) * 24:
+                raise ValueError("Cache files are incomplete")
+            self._open(meta["dim"], meta["capacity"], "r+")
+            self._writes = -1
+            self._refresh()
+            return
+        except (OSError, ValueError, KeyError):
+            if dim is None:
+                return
+        # Replaces a missing, damaged or older cache
+        for filename in ("index.json", "cache.json"):
+            if os.path.isfile(os.path.join(self.path, filename)):
+                os.remove(os.path.join(self.path, filename))
+        self._open(dim, max(self.max_bytes // (dim * 2), 1), "w+")
+        self._table.flush()
+        write_json_atomic(self._meta_path(), {"dim": self.dim, "capacity": self.capacity})
+        self._slots = {}
+        self._writes = 0
+
+    def _refresh(self):
+        """
+        Rebuild the local hints from the slot table if any process wrote to it since they were last built.
+        """
+        writes = int(self._header[0])
+        if writes == self._writes:
+            return
+        keys = np.ascontiguousarray(self._table[:, :2])
+        raw = keys.tobytes()
+        self._slots = {raw[slot * 16:slot * 16 + 16]: slot for slot in np.flatnonzero(keys.any(axis=1)).tolist()}
+        self._writes = writes
+
+    def save(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._table.flush()
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _read(self, key: bytes):
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        if self._table[slot, :2].tobytes() == key:
+            vector = np.array(self._vectors[slot], dtype=np.float32)
+            # Still the same entry after the copy, i.e: not reused by another process meanwhile
+            if self._table[slot, :2].tobytes() == key:
+                self._table[slot, 2] = time.time_ns()
+                return vector
+        del self._slots[key]
+        return None
+
+    def _store(self, entries: dict) -> dict:
+        """
+        Write `{key: vector}` into the shared cache, returning the vectors as stored. Call with the file lock held.
+        """
+        if self._vectors is None:
+            self._attach(len(next(iter(entries.values()))))
+        self._refresh()
+        stored = {}
+        for key in list(entries):
+            # Another process may have cached it since the lookup
+            vector = self._read(key)
+            if vector is not None:
+                stored[key] = vector
+                del entries[key]
+        for key in list(entries)[self.capacity:]:
+            # More misses than the cache can hold, returned without caching them
+            stored[key] = entries.pop(key).astype(np.float16).astype(np.float32)
+        if not entries:
+            return stored
+        free = np.flatnonzero(~self._table[:, :2].any(axis=1))
+        if len(free) < len(entries):
+            # Evict the least recently used entries, oldest first
+            used = np.flatnonzero(self._table[:, :2].any(axis=1))
+            oldest = used[np.argsort(self._table[used, 2], kind="stable")]
+            free = np.concatenate([free, oldest[:len(entries) - len(free)]])
+        now = time.time_ns()
+        for (key, vector), slot in zip(entries.items(), free.tolist()):
+            # Cleared first, so concurrent readers never match a half-written vector
+            self._table[slot, :2] = 0
+            self._vectors[slot] = vector
+            self._table[slot, 2] = now
+            self._table[slot, :2] = np.frombuffer(key, dtype=np.uint64)
+            self._slots[key] = slot
+            stored[key] = self._vectors[slot].astype(np.float32)
+        self._header[0] += len(entries)
+        self._writes += len(entries)
+        return stored
+
+    def __call__(self, input: Documents) -> Embeddings:
+        keys = [self._key(text) for text in input]
+        results = [None] * len(input)
+        missing = {}
+        with self._lock:
+            if self._vectors is not None:
+                self._refresh()
+            for i, key in enumerate(keys):
+                vector = self._read(key) if self._vectors is not None else None
+                if vector is not None:
+                    results[i] = vector
+                    self.hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+
+        if missing:
+            texts = [input[indices[0]] for indices in missing.values()]
+            vectors = np.asarray(self.function(texts), dtype=np.float32)
+            with self._lock, self._file_lock():
+                # Round through float16 so fresh and cached vectors are identical
+                stored = self._store(dict(zip(missing, vectors)))
+            for key, indices in missing.items():
+                for i in indices:
+                    results[i] = stored[key]
+        return [vector.tolist() for vector in results]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": int(self._table[:, :2].any(axis=1).sum()) if self._table is not None else 0,
+            "capacity": self.capacity
+        }
+
+class OnnxEmbeddingFunction(EmbeddingFunction):
+    """
+    Sentence-transformers model run through ONNX Runtime, without importing torch.
+
+    Uses the repo's `onnx/model.onnx` when present, otherwise exports it once. With `quantize`, weights are
+    dynamically quantized to int8 (`onnx/model_int8.onnx`), which is cached next to the full precision model.
+    """
+    def __init__(self, model_dir: str, device: str = None, quantize: bool = False, batch_size: int = 32):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        self.model_dir = model_dir
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = self._read_config("sentence_bert_config.json").get("max_seq_length", self.tokenizer.model_max_length)
+        # Like sentence-transformers, normalize only if the model ships a Normalize module
+        self.normalize = any(module.get("type", "").endswith("Normalize") for module in self._read_config("modules.json", []))
+
+        model_path = self._model_path(quantize)
+        available = onnxruntime.get_available_providers()
+        providers = ["CPUExecutionProvider"]
+        if device != "cpu" and "CUDAExecutionProvider" in available:
+            providers.insert(0, "CUDAExecutionProvider")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=providers)
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def _read_config(self, filename: str, default=None):
+        path = os.path.join(self.model_dir, filename)
+        if not os.path.isfile(path):
+            return {} if default is None else default
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _model_path(self, quantize: bool) -> str:
+        onnx_dir = os.path.join(self.model_dir, "onnx")
+        model_path = os.path.join(onnx_dir, "model.onnx")
+        if not os.path.isfile(model_path):
+            os.makedirs(onnx_dir, exist_ok=True)
+            self._export(model_path)
+        if not quantize:
+            return model_path
+        quantized_path = os.path.join(onnx_dir, "model_int8.onnx")
+        if not os.path.isfile(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+
+    def _export(self, model_path: str):
+        # One-off, the only time torch is needed
+        import torch
+        from transformers import AutoModel
+        model = AutoModel.from_pretrained(self.model_dir).eval()
+        sample = dict(self.tokenizer(["Export sample"], return_tensors="pt"))
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in sample}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(
+                model, (sample,), model_path,
+                input_names=list(sample),
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14
+            )
+
+    def _embed(self, texts: list) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        inputs = {name: encoded[name].astype(np.int64) for name in self.input_names if name in encoded}
+        if "token_type_ids" in self.input_names and "token_type_ids" not in inputs:
+            inputs["token_type_ids"] = np.zeros_like(encoded["input_ids"], dtype=np.int64)
+        hidden = self.session.run(None, inputs)[0]
+        # Mean pooling over real tokens
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if not input:
+            return []
+        # Batch similar lengths together to keep padding down
+        order = sorted(range(len(input)), key=lambda i: len(input[i]))
+        results = [None] * len(input)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._embed([input[i] for i in batch])):
+                results[i] = vector.tolist()
+        return results
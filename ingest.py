@@ -0,0 +1,265 @@
+"""
+Bulk ingestion of documents into a persona's external memory.
+
+Run with `python ingest.py <persona> <paths...>`. Files are streamed one at a time, chunked on paragraph and
+sentence boundaries to fit the embedding model, embedded across a process pool and written in large batches.
+Progress is checkpointed after every write, so an interrupted run picks up where it left off.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from utils import log, LogType, clean_scrape, split_paragraph, write_json_atomic
+import multiprocessing
+import argparse
+import hashlib
+import time
+import json
+import os
+import re
+
+TEXT_EXTENSIONS = (".txt", ".md", ".rst", ".html", ".htm", ".csv")
+# Fields tried, in order, for the text of a JSON record (e.g: exported chats)
+TEXT_FIELDS = ("content", "text", "body", "message")
+
+def _record_text(record) -> str:
+    if isinstance(record, str):
+        return record
+    if isinstance(record, dict):
+        for field in TEXT_FIELDS:
+            if isinstance(record.get(field), str):
+                return record[field]
+    return ""
+
+def iter_documents(paths: list):
+    """
+    Lazily yield `(document_id, text)` for every supported file under `paths`, in a stable order.
+
+    `.jsonl` files yield one document per line; `.json` files holding a list yield one per item.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            files = [path]
+        for file_path in files:
+            extension = os.path.splitext(file_path)[1].lower()
+            if extension == ".jsonl":
+                with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+                    for n, line in enumerate(file):
+                        if line.strip():
+                            yield f"{file_path}:{n}", _record_text(json.loads(line))
+            elif extension == ".json":
+                with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+                    records = json.load(file)
+                for n, record in enumerate(records if isinstance(records, list) else [records]):
+                    yield f"{file_path}:{n}", _record_text(record)
+            elif extension in TEXT_EXTENSIONS:
+                with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+                    yield file_path, file.read()
+
+class TokenCounter:
+    """
+    Counts tokens with the embedding model's own tokenizer, or estimates from words if it isn't available.
+    """
+    def __init__(self, model_dir: str):
+        self.tokenizer = None
+        self.max_tokens = 256
+        try:
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        except Exception:
+            log(LogType.warning, "[Ingest] Embedding tokenizer unavailable, estimating token counts from words.")
+        config_path = os.path.join(model_dir, "sentence_bert_config.json")
+        if os.path.isfile(config_path):
+            with open(config_path, "r", encoding="utf-8") as file:
+                self.max_tokens = json.load(file).get("max_seq_length", self.max_tokens)
+        # Room for the special tokens the model adds
+        self.max_tokens -= 2
+
+    def __call__(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+        return int(len(text.split()) * 1.3) + 1
+
+def _split(text: str, count: TokenCounter, max_tokens: int) -> list[str]:
+    if count(text) <= max_tokens:
+        return [text]
+    first, second = split_paragraph(text)
+    if not first.strip() or not second.strip():
+        # A single long sentence, split on words instead
+        words = text.split()
+        middle = len(words) // 2
+        if middle == 0:
+            return [text]
+        first, second = " ".join(words[:middle]), " ".join(words[middle:])
+    return _split(first.strip(), count, max_tokens) + _split(second.strip(), count, max_tokens)
+
+def chunk_document(text: str, count: TokenCounter, max_tokens: int = None) -> list[str]:
+    """
+    Pack the document's paragraphs into chunks of at most `max_tokens`, splitting long paragraphs at sentences.
+    """
+    max_tokens = max_tokens or count.max_tokens
+    paragraphs = [clean_scrape(paragraph).strip() for paragraph in re.split(r"\n\s*\n", text)]
+    pieces = [piece for paragraph in paragraphs if paragraph for piece in _split(paragraph, count, max_tokens)]
+    chunks = []
+    current, current_tokens = [], 0
+    for piece in pieces:
+        tokens = count(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+_worker_embedding = None
+
+def _init_worker(embedding: str, backend: str, threads: int):
+    global _worker_embedding
+    # Keep workers from oversubscribing the CPU between them
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    from memory import create_embedding_function, Device
+    _worker_embedding = create_embedding_function(embedding, Device.cpu, backend)
+    if hasattr(_worker_embedding, "_model"):
+        import torch
+        torch.set_num_threads(threads)
+
+def _embed(texts: list):
+    import numpy as np
+    return np.asarray(_worker_embedding(texts), dtype=np.float32)
+
+class Checkpoint:
+    """
+    Ingestion progress for one set of input paths: documents fully written, and the next memory ID after them.
+    """
+    def __init__(self, path: str, paths: list):
+        self.path = path
+        self.key = hashlib.sha256(json.dumps(sorted(os.path.abspath(p) for p in paths)).encode("utf-8")).hexdigest()[:16]
+        self.documents = 0
+        self.next_id = None
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as file:
+                state = json.load(file)
+            if state.get("key") == self.key:
+                self.documents = state["documents"]
+                self.next_id = state["next_id"]
+
+    def save(self, documents: int, next_id: int):
+        self.documents = documents
+        self.next_id = next_id
+        write_json_atomic(self.path, {"key": self.key, "documents": documents, "next_id": next_id})
+
+def ingest(
+    persona_name: str,
+    paths: list,
+    workers: int = None,
+    batch_size: int = 64,
+    write_size: int = 4096,
+    max_tokens: int = None,
+    report_every: float = 5.0
+) -> dict:
+    """
+    Stream every document under `paths` into the persona's external memory. Returns throughput stats.
+    """
+    from memory import ExternalMemory
+    import numpy as np
+    store = ExternalMemory(persona_name)
+    count = TokenCounter(f"./embeddings/{store.embedding_name}")
+    checkpoint = Checkpoint(os.path.join(store.path, "ingest.json"), paths)
+    if checkpoint.next_id is not None and store.ids.next_id > checkpoint.next_id:
+        # Drop chunks of this run written after the last checkpoint, their documents are ingested again
+        stored = store.index.get(ids=[str(_id) for _id in range(checkpoint.next_id, store.ids.next_id)], include=["metadatas"])
+        partial = [_id for _id, metadata in zip(stored["ids"], stored["metadatas"]) if (metadata or {}).get("ingest") == checkpoint.key]
+        if partial:
+            store.index.delete(ids=partial)
+    if checkpoint.documents:
+        log(LogType.system, f"[Ingest] Resuming after {checkpoint.documents} documents.")
+    checkpoint.save(checkpoint.documents, store.ids.next_id)
+
+    workers = workers or max(1, (os.cpu_count() or 2) // 2)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context("spawn")
+    stats = {"documents": 0, "chunks": 0, "seconds": 0.0}
+    pending_writes = {"ids": [], "embeddings": [], "documents": [], "metadatas": []}
+    written_documents = checkpoint.documents
+    in_flight = deque()
+    start = time.perf_counter()
+    last_report = start
+
+    def write():
+        if pending_writes["ids"]:
+            embeddings = np.concatenate(pending_writes["embeddings"])
+            step = getattr(store.client, "max_batch_size", write_size)
+            for i in range(0, len(pending_writes["ids"]), step):
+                end = i + step
+                store.index.add(
+                    ids=pending_writes["ids"][i:end],
+                    embeddings=embeddings[i:end].tolist(),
+                    documents=pending_writes["documents"][i:end],
+                    metadatas=pending_writes["metadatas"][i:end]
+                )
+            for values in pending_writes.values():
+                values.clear()
+        checkpoint.save(written_documents, store.ids.next_id)
+
+    def collect(block: bool):
+        # Results are consumed in submission order so the checkpoint always covers a prefix of the stream
+        nonlocal written_documents, last_report
+        while in_flight and (block or in_flight[0][0].done()):
+            future, chunks, metadatas, documents_done = in_flight.popleft()
+            pending_writes["embeddings"].append(future.result())
+            pending_writes["ids"].extend(store.ids.allocate(len(chunks)))
+            pending_writes["documents"].extend(chunks)
+            pending_writes["metadatas"].extend(metadatas)
+            written_documents = documents_done
+            stats["chunks"] += len(chunks)
+            if len(pending_writes["ids"]) >= write_size:
+                write()
+            now = time.perf_counter()
+            if now - last_report >= report_every:
+                last_report = now
+                elapsed = now - start
+                log(LogType.system, f"[Ingest] {stats['documents']} docs ({stats['documents'] / elapsed:.1f} docs/s), {stats['chunks']} chunks ({stats['chunks'] / elapsed:.1f} chunks/s)")
+            if block and len(in_flight) < workers * 2:
+                break
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(store.embedding_name, store.backend, threads)) as pool:
+        batch, batch_metadatas = [], []
+        position = 0
+        for position, (document_id, text) in enumerate(iter_documents(paths), start=1):
+            if position <= checkpoint.documents:
+                continue
+            chunks = chunk_document(text, count, max_tokens)
+            batch.extend(chunks)
+            batch_metadatas.extend({"document": document_id, "chunk": n, "ingest": checkpoint.key} for n in range(len(chunks)))
+            stats["documents"] += 1
+            # Batches end on document boundaries, so finished batches always mean finished documents
+            if len(batch) >= batch_size:
+                in_flight.append((pool.submit(_embed, batch), batch, batch_metadatas, position))
+                batch, batch_metadatas = [], []
+                collect(block=len(in_flight) >= workers * 2)
+        if batch:
+            in_flight.append((pool.submit(_embed, batch), batch, batch_metadatas, position))
+        while in_flight:
+            collect(block=True)
+        # Covers trailing documents without any text
+        written_documents = max(written_documents, position)
+        write()
+
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    stats["docs/s"] = round(stats["documents"] / stats["seconds"], 1) if stats["seconds"] else 0.0
+    stats["chunks/s"] = round(stats["chunks"] / stats["seconds"], 1) if stats["seconds"] else 0.0
+    log(LogType.system, f"[Ingest] Done: {stats['documents']} docs, {stats['chunks']} chunks in {stats['seconds']}s ({stats['docs/s']} docs/s, {stats['chunks/s']} chunks/s)")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest documents into a persona's external memory")
+    parser.add_argument("persona")
+    parser.add_argument("paths", nargs="+", help="Files or folders (.txt, .md, .html, .json, .jsonl, ...)")
+    parser.add_argument("--workers", type=int, default=None, help="Embedding processes (default: half the CPU cores)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Chunks per embedding call")
+    parser.add_argument("--write-size", type=int, default=4096, help="Chunks per collection write")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Chunk size (default: the embedding model's limit)")
+    args = parser.parse_args()
+    ingest(args.persona, args.paths, workers=args.workers, batch_size=args.batch_size, write_size=args.write_size, max_tokens=args.max_tokens)
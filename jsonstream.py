@@ -0,0 +1,91 @@
+import json
+
+class JSONStreamParser:
+    """
+    Incremental JSON parser for streamed completions.
+
+    `feed()` text as it arrives and get back `(path, value)` events for every value that has just
+    been closed, down to `max_depth` (e.g: `("thoughts",)` or `("functions", 0)`).
+    The root value is emitted with an empty path once the whole document is closed.
+    """
+    def __init__(self, max_depth: int = 2):
+        self.max_depth = max_depth
+        self.done = False
+        self._chars = []
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._string_is_key = False
+        self._scalar_start = None
+
+    def text(self) -> str:
+        return "".join(self._chars)
+
+    def _path(self) -> tuple:
+        return tuple(frame["key"] if frame["kind"] == "object" else frame["index"] for frame in self._stack)
+
+    def _complete(self, start: int, end: int, events: list):
+        path = self._path()
+        if len(path) <= self.max_depth:
+            value = json.loads("".join(self._chars[start:end + 1]))
+            events.append((path, value))
+        if self._stack:
+            self._stack[-1]["expect"] = "comma"
+        else:
+            self.done = True
+
+    def feed(self, text: str) -> list[tuple]:
+        events = []
+        for ch in text:
+            pos = len(self._chars)
+            self._chars.append(ch)
+            if self.done:
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == "\"":
+                    self._in_string = False
+                    if self._string_is_key:
+                        frame = self._stack[-1]
+                        frame["key"] = json.loads("".join(self._chars[self._string_start:pos + 1]))
+                        frame["expect"] = "colon"
+                    else:
+                        self._complete(self._string_start, pos, events)
+                continue
+
+            if self._scalar_start is not None and (ch in ",}]" or ch.isspace()):
+                self._complete(self._scalar_start, pos - 1, events)
+                self._scalar_start = None
+
+            frame = self._stack[-1] if self._stack else None
+            if ch == "\"":
+                self._in_string = True
+                self._string_start = pos
+                self._string_is_key = frame is not None and frame["kind"] == "object" and frame["expect"] == "key"
+            elif ch in "{[":
+                self._stack.append({
+                    "kind": "object" if ch == "{" else "array",
+                    "start": pos,
+                    "key": None,
+                    "index": 0,
+                    "expect": "key" if ch == "{" else "value"
+                })
+            elif ch in "}]":
+                closed = self._stack.pop()
+                self._complete(closed["start"], pos, events)
+            elif ch == ":":
+                frame["expect"] = "value"
+            elif ch == ",":
+                if frame["kind"] == "object":
+                    frame["expect"] = "key"
+                else:
+                    frame["index"] += 1
+                    frame["expect"] = "value"
+            elif not ch.isspace() and self._scalar_start is None:
+                self._scalar_start = pos
+        return events
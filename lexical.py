@@ -0,0 +1,123 @@
+from collections import Counter
+from utils import write_json_atomic
+import threading
+import math
+import json
+import os
+import re
+
+STOPWORDS = set("""
+a an and are as at be but by did do does for from had has have how i if in into is it its me my of on or our
+s so that the their them they this to was we were what when where which who why will with you your
+""".split())
+
+def terms(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+class BM25Index:
+    """
+    Local BM25 inverted index kept alongside a memory collection, persisted as `lexical.json`.
+
+    `stamp` is an opaque value saved with the index (e.g: the next memory ID), so callers can tell a stale
+    snapshot from a current one.
+    """
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        self.path = os.path.join(path, "lexical.json")
+        self.k1 = k1
+        self.b = b
+        self.stamp = None
+        self.postings = {}
+        # id: [source, length, terms]
+        self.docs = {}
+        self.total_length = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    snapshot = json.load(file)
+                self.stamp = snapshot["stamp"]
+                self.postings = snapshot["postings"]
+                self.docs = snapshot["docs"]
+                self.total_length = sum(doc[1] for doc in self.docs.values())
+            except (ValueError, KeyError):
+                self.stamp = None
+
+    def _remove(self, _id: str):
+        doc = self.docs.pop(_id, None)
+        if doc is None:
+            return
+        self.total_length -= doc[1]
+        for term in doc[2]:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(_id, None)
+                if not postings:
+                    del self.postings[term]
+
+    def add(self, ids: list, documents: list, sources: list):
+        """
+        Index documents, replacing any previous version of the same IDs.
+        """
+        with self._lock:
+            for _id, document, source in zip(ids, documents, sources):
+                if _id in self.docs:
+                    self._remove(_id)
+                counts = Counter(terms(document))
+                for term, count in counts.items():
+                    self.postings.setdefault(term, {})[_id] = count
+                length = sum(counts.values())
+                self.docs[_id] = [source, length, list(counts)]
+                self.total_length += length
+            self._dirty = True
+
+    def remove(self, ids: list):
+        with self._lock:
+            for _id in ids:
+                self._remove(_id)
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self.postings = {}
+            self.docs = {}
+            self.total_length = 0
+            self._dirty = True
+
+    def search(self, query: str, source: str = None, limit: int = 5) -> list[tuple]:
+        """
+        Top matches as `(id, score, coverage)`, where coverage is the share of the query's keywords
+        (ignoring stopwords) found in the entry.
+        """
+        query_terms = set(terms(query))
+        keywords = query_terms - STOPWORDS or query_terms
+        with self._lock:
+            if not self.docs or not query_terms:
+                return []
+            total = len(self.docs)
+            average_length = self.total_length / total
+            scores = {}
+            matched = {}
+            for term in query_terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for _id, count in postings.items():
+                    doc_source, length, _ = self.docs[_id]
+                    if source is not None and doc_source != source:
+                        continue
+                    norm = count + self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[_id] = scores.get(_id, 0.0) + idf * count * (self.k1 + 1) / norm
+                    if term in keywords:
+                        matched[_id] = matched.get(_id, 0) + 1
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(_id, score, matched.get(_id, 0) / len(keywords)) for _id, score in ranked]
+
+    def save(self, stamp=None):
+        with self._lock:
+            if not self._dirty and stamp == self.stamp:
+                return
+            self.stamp = stamp
+            write_json_atomic(self.path, {"stamp": stamp, "docs": self.docs, "postings": self.postings})
+            self._dirty = False
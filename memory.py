@@ -3,14 +3,30 @@ from chromadb.config import Settings as ChromaSettings
 from chromadb.utils import embedding_functions
 from chromadb.types import Where, WhereDocument
 from typing import Literal
-from utils import log, LogType, get_dir, get_caller_path, _boot_padding
+from utils import log, LogType, get_dir, get_caller_path, _boot_padding, write_json_atomic
+from embeddings import CachedEmbeddingFunction, OnnxEmbeddingFunction
+from lexical import BM25Index
+from vectorstore import NumpyClient
+import settings
 from huggingface_hub import snapshot_download
 from tqdm.auto import tqdm
 import logging
+import socket
+import threading
+import time
+import json
+import math
+import re
+import os
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 
 logging.getLogger("chromadb").setLevel(logging.CRITICAL)
 
 active_embeddings = {}
+_embeddings_lock = threading.Lock()
+_loader_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory")
 
 class Device:
     cpu = "cpu"
@@ -22,77 +38,954 @@ class Embedding:
     balanced = "all-distilroberta-v1"
     precise = "all-mpnet-base-v2"
 
-def _get_embedding(embedding: Embedding, device: Device):
-    global active_embeddings
+class Backend:
+    torch = "torch"
+    onnx = "onnx"
+    onnx_int8 = "onnx-int8"
+
+def _get_embedding(embedding: Embedding, device: Device, backend: Backend = None):
+    # Stores may be built on background threads
+    with _embeddings_lock:
+        return _load_embedding(embedding, device, backend or settings.embedding_backend)
+
+def create_embedding_function(embedding: Embedding, device: Device = Device.auto, backend: Backend = Backend.torch):
+    """
+    Build an uncached embedding function for `embedding` on the given backend, downloading the model if needed.
+    """
     if not get_dir(f"embeddings/{embedding}"):
         log(LogType.download, f"[Memory] Downloading embedding: {embedding}...", with_prefix=False)
         snapshot_download(f"sentence-transformers/{embedding}", local_dir=f"./embeddings/{embedding}", tqdm_class=tqdm)
-    if embedding not in active_embeddings:
-        embedding_instance = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=f"./embeddings/{embedding}", device=device)
-        active_embeddings[embedding] = embedding_instance
-    return active_embeddings[embedding]
+    if backend in (Backend.onnx, Backend.onnx_int8):
+        return OnnxEmbeddingFunction(f"./embeddings/{embedding}", device=device, quantize=backend == Backend.onnx_int8)
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=f"./embeddings/{embedding}", device=device)
+
+def _load_embedding(embedding: Embedding, device: Device, backend: Backend = Backend.torch):
+    global active_embeddings
+    # Backends don't produce bit-identical vectors, so each gets its own cache
+    name = embedding if backend == Backend.torch else f"{embedding}-{backend}"
+    if name not in active_embeddings and settings.embedding_service:
+        if hasattr(socket, "AF_UNIX"):
+            # Deferred, the service module is only needed when it's enabled
+            from embedding_service import EmbeddingClient
+            active_embeddings[name] = EmbeddingClient(embedding, device, backend, socket_path=settings.embedding_socket or None)
+        else:
+            log(LogType.warning, "[Memory] Unix sockets unavailable, EMBEDDING_SERVICE ignored.")
+    if name not in active_embeddings:
+        embedding_instance = create_embedding_function(embedding, device, backend)
+        if settings.embedding_cache_mb > 0:
+            embedding_instance = CachedEmbeddingFunction(embedding_instance, name, max_mb=settings.embedding_cache_mb)
+        active_embeddings[name] = embedding_instance
+    return active_embeddings[name]
+
+def embedding_stats() -> dict:
+    """
+    Cache hit rates of every loaded embedding, keyed by embedding name.
+    """
+    return {name: function.stats() for name, function in active_embeddings.items() if hasattr(function, "stats")}
+
+def _create_client(path: str):
+    """
+    Vector store client for `MEMORY_BACKEND`: `chroma` (sqlite + HNSW) or `numpy` (in-process brute force).
+    """
+    if settings.memory_backend == "numpy":
+        client = NumpyClient(path)
+        _import_chroma(client, path)
+        return client
+    return chromadb.PersistentClient(path, settings=ChromaSettings(anonymized_telemetry=False))
+
+def _collection_names(client) -> list[str]:
+    # chromadb returns collection objects, the NumPy client plain names
+    return [getattr(collection, "name", collection) for collection in client.list_collections()]
+
+def _import_chroma(client: NumpyClient, path: str):
+    """
+    One-off import of a store previously kept in chromadb into NumPy collections, reusing its embeddings.
+
+    Progress is kept in `chroma.imported`, so chromadb is never opened again once it's done.
+    """
+    marker_path = os.path.join(path, "chroma.imported")
+    state = {"done": False, "importing": None}
+    if os.path.isfile(marker_path):
+        with open(marker_path, "r", encoding="utf-8") as file:
+            state = json.load(file)
+    if state["done"] or not os.path.isfile(os.path.join(path, "chroma.sqlite3")):
+        return
+
+    def save_state(**changes):
+        state.update(changes)
+        write_json_atomic(marker_path, state)
+
+    if state["importing"]:
+        # Interrupted part way through, start that collection over
+        client.delete_collection(state["importing"])
+    existing = set(_collection_names(client))
+    legacy = chromadb.PersistentClient(path, settings=ChromaSettings(anonymized_telemetry=False))
+    for name in _collection_names(legacy):
+        # Collections already holding data were imported or written since
+        if name in existing and client.get_or_create_collection(name).count():
+            continue
+        stored = legacy.get_collection(name, embedding_function=None).get(include=["embeddings", "documents", "metadatas"])
+        if not stored["ids"]:
+            continue
+        log(LogType.system, f"[Memory] Importing {len(stored['ids'])} memories from chromadb...")
+        save_state(importing=name)
+        collection = client.get_or_create_collection(name)
+        for start in range(0, len(stored["ids"]), client.max_batch_size):
+            end = start + client.max_batch_size
+            collection.add(ids=stored["ids"][start:end], embeddings=stored["embeddings"][start:end], documents=stored["documents"][start:end], metadatas=stored["metadatas"][start:end])
+    save_state(done=True, importing=None)
+
+def _get_collection(client, name: str, embedding):
+    return client.get_or_create_collection(name, embedding_function=embedding, metadata={"hnsw:space": "cosine"})
+
+class IdAllocator:
+    """
+    Persisted monotonic ID counter for a memory store, shared by all of its collections.
+
+    IDs are never reused, so deletes can't cause collisions.
+    """
+    def __init__(self, path: str, *indexes):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.next_id = json.load(file)["next_id"]
+        else:
+            # Seed past any IDs written before the allocator existed
+            existing = [int(_id) for index in indexes for _id in index.get(include=[])["ids"] if _id.isdigit()]
+            self.next_id = max(existing, default=0) + 1
+            self._save()
+
+    def _save(self):
+        write_json_atomic(self.path, {"next_id": self.next_id})
+
+    def allocate(self, count: int = 1) -> list[str]:
+        with self._lock:
+            ids = [str(_id) for _id in range(self.next_id, self.next_id + count)]
+            self.next_id += count
+            self._save()
+            return ids
+
+def _batched_add(client, index, ids: list, documents: list, metadatas: list = None):
+    """
+    Write entries in as few collection calls as the client allows. Each call embeds its documents in one batch.
+    """
+    batch_size = getattr(client, "max_batch_size", 5000)
+    for i in range(0, len(ids), batch_size):
+        index.add(
+            ids=ids[i:i + batch_size],
+            documents=documents[i:i + batch_size],
+            metadatas=metadatas[i:i + batch_size] if metadatas else None
+        )
+
+def _format_memories(memories: list[str]) -> str:
+    if memories:
+        return "\n".join([f"- {memory}" for memory in memories])
+    else:
+        return "No relevant memories found!"
+
+# Internal memory collection of each source is named SHARD_PREFIX + source
+SHARD_PREFIX = "source-"
+# Entries replaced by a consolidated summary, kept out of searches
+SUPERSEDED = "superseded"
+
+MIN_SCORE = 0.5
+MAX_PER_QUERY = 5
+# Reciprocal rank fusion constant
+RRF_K = 60
+
+def _score(distance: float) -> float:
+    return round(1 - (distance / 2), 3)
+
+def _combine_results(*results: dict) -> dict:
+    """
+    Merge several multi-query results over the same queries, keeping each query's hits ordered by distance.
+    """
+    combined = {"ids": [], "distances": [], "documents": []}
+    for q in range(len(results[0]["ids"])):
+        hits = sorted(
+            (hit for result in results for hit in zip(result["distances"][q], result["ids"][q], result["documents"][q])),
+            key=lambda hit: hit[0]
+        )
+        combined["distances"].append([hit[0] for hit in hits])
+        combined["ids"].append([hit[1] for hit in hits])
+        combined["documents"].append([hit[2] for hit in hits])
+    return combined
+
+def _merge_results(query_results: dict, min_score: float = MIN_SCORE, returned_ids: list = None) -> list[str]:
+    """
+    Flatten a multi-query result into unique documents above `min_score`, in query order.
+    IDs of the returned documents are appended to `returned_ids` if given.
+    """
+    seen_ids = set()
+    memories = []
+    for q in range(len(query_results["ids"])):
+        for i in range(len(query_results["ids"][q])):
+            _id = int(query_results["ids"][q][i])
+            if _id not in seen_ids:
+                seen_ids.add(_id)
+                if _score(query_results["distances"][q][i]) >= min_score:
+                    memories.append(query_results["documents"][q][i])
+                    if returned_ids is not None:
+                        returned_ids.append(query_results["ids"][q][i])
+    return memories
+
+def _merge_rankings(rankings: list) -> tuple[list, list]:
+    """
+    Flatten per-query `(id, document, kept)` rankings into unique kept documents and their IDs, in query order.
+    """
+    seen_ids = set()
+    memories, returned_ids = [], []
+    for ranking in rankings:
+        for _id, document, kept in ranking:
+            if _id not in seen_ids:
+                seen_ids.add(_id)
+                if kept:
+                    memories.append(document)
+                    returned_ids.append(_id)
+    return memories, returned_ids
+
+class WriteBehindQueue:
+    """
+    Durable write-behind buffer for a memory collection.
+
+    Entries are appended (and fsynced) to `journal.jsonl` as soon as they're queued, then embedded and written
+    to the collection in batches by a background worker. Anything left in the journal is replayed on startup,
+    so writes queued before a crash aren't lost. Unflushed entries can still be searched with `scan()`.
+    """
+    def __init__(self, path: str, client, route, embedding, batch_size: int = 256, interval: float = 1.0):
+        self.path = os.path.join(path, "journal.jsonl")
+        self.client = client
+        # Collection each entry belongs in, given its metadata
+        self.route = route
+        self.embedding = embedding
+        self.batch_size = min(batch_size, getattr(client, "max_batch_size", batch_size))
+        self.interval = interval
+        self.pending = OrderedDict()
+        self.flushed = 0
+        self._vectors = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._replay()
+        self._worker = threading.Thread(target=self._run, name="memory-writer", daemon=True)
+        self._worker.start()
+
+    def _replay(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partial line from an interrupted write
+                    continue
+                self.pending[entry["id"]] = (entry["document"], entry["metadata"])
+        if self.pending:
+            log(LogType.system, f"[Memory] Replaying {len(self.pending)} unflushed memories from journal.")
+            self._wake.set()
+
+    def put(self, ids: list, documents: list, metadatas: list = None):
+        metadatas = metadatas or [None] * len(ids)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                for _id, document, metadata in zip(ids, documents, metadatas):
+                    file.write(json.dumps({"id": _id, "document": document, "metadata": metadata}) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            for _id, document, metadata in zip(ids, documents, metadatas):
+                self.pending[_id] = (document, metadata)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self._drain()
+            except Exception as e:
+                # Entries stay journaled and pending, retried on the next pass
+                log(LogType.error, f"[Memory] Write-behind flush failed: {e}")
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                batch = list(self.pending.items())[:self.batch_size]
+            if not batch:
+                return
+            ids = [_id for _id, _ in batch]
+            documents = [document for _, (document, _) in batch]
+            metadatas = [metadata for _, (_, metadata) in batch]
+            embeddings = self.embedding(documents)
+            groups = {}
+            for i, metadata in enumerate(metadatas):
+                collection = self.route(metadata)
+                groups.setdefault(id(collection), (collection, []))[1].append(i)
+            for collection, rows in groups.values():
+                # Upsert so a replayed journal can't duplicate entries that were written before a crash
+                collection.upsert(
+                    ids=[ids[i] for i in rows],
+                    embeddings=[embeddings[i] for i in rows],
+                    documents=[documents[i] for i in rows],
+                    metadatas=[metadatas[i] for i in rows] if any(metadatas) else None
+                )
+            with self._lock:
+                for _id in ids:
+                    self.pending.pop(_id, None)
+                    self._vectors.pop(_id, None)
+                self.flushed += len(ids)
+                if not self.pending:
+                    # Everything is in the collection, start a fresh journal
+                    open(self.path, "w").close()
+                    self._idle.notify_all()
+
+    def documents(self, ids: list) -> dict:
+        """
+        Text of the given IDs that are still queued.
+        """
+        with self._lock:
+            return {_id: self.pending[_id][0] for _id in ids if _id in self.pending}
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Block until every queued entry is written to the collection. Returns `False` on timeout.
+        """
+        self._wake.set()
+        with self._idle:
+            return self._idle.wait_for(lambda: not self.pending, timeout)
+
+    def scan(self, query_embeddings: list, where: dict = None, n_results: int = MAX_PER_QUERY) -> dict:
+        """
+        Brute-force cosine search over unflushed entries, in the collection's multi-query result format.
+        """
+        with self._lock:
+            entries = [
+                (_id, document) for _id, (document, metadata) in self.pending.items()
+                if not where or all((metadata or {}).get(key) == value for key, value in where.items())
+            ]
+            missing = [(_id, document) for _id, document in entries if _id not in self._vectors]
+        results = {"ids": [], "distances": [], "documents": []}
+        if missing:
+            vectors = np.asarray(self.embedding([document for _, document in missing]), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+            with self._lock:
+                for (_id, _), vector in zip(missing, vectors):
+                    if _id in self.pending:
+                        self._vectors[_id] = vector
+        with self._lock:
+            # Entries flushed meanwhile are already returned by the collection
+            entries = [(_id, document, self._vectors[_id]) for _id, document in entries if _id in self._vectors]
+        if not entries:
+            for _ in query_embeddings:
+                for key in results:
+                    results[key].append([])
+            return results
+
+        matrix = np.stack([vector for _, _, vector in entries])
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-12
+        distances = 1 - queries @ matrix.T
+        for row in distances:
+            top = np.argsort(row)[:n_results]
+            results["ids"].append([entries[i][0] for i in top])
+            results["distances"].append([float(row[i]) for i in top])
+            results["documents"].append([entries[i][1] for i in top])
+        return results
+
+class AccessLog:
+    """
+    Per-entry recall stats (`[hits, last_access]`), persisted in `access.json`. Drives memory decay.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.join(path, "access.json")
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.entries = json.load(file)
+
+    def touch(self, ids: list):
+        now = time.time()
+        with self._lock:
+            for _id in ids:
+                hits, _ = self.entries.get(_id, (0, 0))
+                self.entries[_id] = [hits + 1, now]
+            self._dirty = self._dirty or bool(ids)
+
+    def forget(self, ids: list):
+        with self._lock:
+            for _id in ids:
+                if self.entries.pop(_id, None) is not None:
+                    self._dirty = True
+
+    def decay(self, _id: str, created: float | None, now: float) -> float:
+        """
+        Halves every `MEMORY_HALF_LIFE_DAYS` since the entry was written or last recalled, boosted by recall count.
+
+        Entries written before `created` was recorded age from the first time they're seen here.
+        """
+        with self._lock:
+            if created is None and _id not in self.entries:
+                self.entries[_id] = [0, now]
+                self._dirty = True
+            hits, last_access = self.entries.get(_id, (0, 0))
+        age_days = max(now - max(created or 0, last_access), 0) / 86400
+        return (0.5 ** (age_days / settings.memory_half_life_days)) * (1 + math.log1p(hits))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            write_json_atomic(self.path, self.entries)
+            self._dirty = False
+
+class MemoryLoader:
+    """
+    Builds a memory store off the boot path.
+
+    Attribute access is forwarded to the store, blocking until it's ready, so it can stand in for the store itself.
+    - `background`: Start building immediately on a worker thread.
+    - `lazy`: Build on first use.
+    """
+    def __init__(self, factory, *args, mode: Literal["background", "lazy"] = "background", **kwargs):
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._future = None
+        self._start_lock = threading.Lock()
+        self.load_time = None
+        if mode == "background":
+            self.start()
+
+    def _build(self):
+        started = time.perf_counter()
+        store = self._factory(*self._args, **self._kwargs)
+        self.load_time = time.perf_counter() - started
+        return store
+
+    def start(self) -> Future:
+        with self._start_lock:
+            if self._future is None:
+                self._future = _loader_pool.submit(self._build)
+            return self._future
+
+    def ready(self) -> bool:
+        # Built without errors, a failed build re-raises on attribute access
+        return self._future is not None and self._future.done() and self._future.exception() is None
+
+    def result(self):
+        return self.start().result()
+
+    def __getattr__(self, name):
+        return getattr(self.result(), name)
+
+def load_store(factory, *args, **kwargs):
+    """
+    Build a memory store according to `MEMORY_INIT` (`eager`, `background` or `lazy`).
+    """
+    if settings.memory_init == "eager":
+        return factory(*args, **kwargs)
+    return MemoryLoader(factory, *args, mode=settings.memory_init, **kwargs)
 
 class ExternalMemory:
-    def __init__(self, persona_name: str, embedding: Embedding = Embedding.balanced, device = Device.auto):
+    def __init__(self, persona_name: str, embedding: Embedding = Embedding.balanced, device = Device.auto, backend: Backend = None):
         log(LogType.boot_sequence, _boot_padding(f"[Memory] Loading external memory..."))
-        _embedding = _get_embedding(embedding, device)
-        self.client = chromadb.PersistentClient(f"./personas/{persona_name}/memories/external", settings=ChromaSettings(anonymized_telemetry=False))
-        self.index = self.client.get_or_create_collection("index", embedding_function=_embedding, metadata={"hnsw:space": "cosine"})
+        _embedding = _get_embedding(embedding, device, backend)
+        self.embedding_name = embedding
+        self.backend = backend or settings.embedding_backend
+        self.path = f"./personas/{persona_name}/memories/external"
+        self.client = _create_client(self.path)
+        self.index = _get_collection(self.client, "index", _embedding)
+        self.ids = IdAllocator(os.path.join(self.path, "ids.json"), self.index)
 
     def delete(self, where: Where = None, where_document: WhereDocument = None):
         self.index.delete(where=where, where_document=where_document)
 
-    def add(self, content: str):
-        _id = str(self.index.count() + 1)
-        self.index.add(ids=[_id], documents=[content])
+    def add(self, content: str | list):
+        documents = [content] if isinstance(content, str) else list(content)
+        if not documents:
+            return
+        _batched_add(self.client, self.index, self.ids.allocate(len(documents)), documents)
     
     def query(self, queries: list):
-        min_score = 0.5
-        max_per_query = 5
-        get_score = lambda x: round(1 - (x / 2), 3)
-        seen_ids = set()
         memories = []
-        for query in queries:
-            query_results = self.index.query(query_texts=[query], n_results=max_per_query)
-            for i in range(len(query_results["ids"][0])):
-                _id = int(query_results["ids"][0][i])
-                if _id not in seen_ids:
-                    seen_ids.add(_id)
-                    score = get_score(query_results["distances"][0][i])
-                    if score >= min_score:
-                        memories.append(query_results["documents"][0][i])
+        if queries:
+            query_results = self.index.query(query_texts=list(queries), n_results=MAX_PER_QUERY)
+            memories = _merge_results(query_results)
         if memories:
             return memories
         else:
             return "No relevant external memories found!"
 
 class InternalMemory:
-    def __init__(self, persona_name: str, embedding: Embedding = Embedding.balanced, device: Device = Device.auto):
+    def __init__(self, persona_name: str, embedding: Embedding = Embedding.balanced, device: Device = Device.auto, backend: Backend = None):
         log(LogType.boot_sequence, _boot_padding(f"[Memory] Loading internal memory..."))
-        _embedding = _get_embedding(embedding, device)
-        self.client = chromadb.PersistentClient(f"./personas/{persona_name}/memories/internal", settings=ChromaSettings(anonymized_telemetry=False))
-        self.index = self.client.get_or_create_collection("index", embedding_function=_embedding, metadata={"hnsw:space": "cosine"})
+        _embedding = _get_embedding(embedding, device, backend)
+        self.path = f"./personas/{persona_name}/memories/internal"
+        # Not every backend creates it before the first write
+        os.makedirs(self.path, exist_ok=True)
+        self.client = _create_client(self.path)
+        self.embedding = _embedding
+        # One collection per source, so searching one source doesn't scan the others
+        self.shards = {}
+        self._shards_lock = threading.Lock()
+        for name in self._shard_names():
+            self.shard(name.removeprefix(SHARD_PREFIX))
+        self._migrate_shards()
+        self.superseded = _get_collection(self.client, SUPERSEDED, self.embedding)
+        self.ids = IdAllocator(os.path.join(self.path, "ids.json"), *self.shards.values(), self.superseded)
+        self.writer = WriteBehindQueue(self.path, self.client, lambda metadata: self.shard(metadata["source"]), _embedding) if settings.memory_write_behind else None
+        # Near-duplicate writes dropped or folded into an existing entry
+        self.suppressed = {"skipped": 0, "merged": 0}
+        # Bumped on every change to a source, so cached results can tell they're stale
+        self.writes = {}
+        self.access = AccessLog(self.path)
+        self.consolidation_path = os.path.join(self.path, "consolidation.json")
+        self.consolidated = {"clusters": 0, "entries": 0}
+        self._consolidating = threading.Lock()
+        self.lexical = BM25Index(self.path)
+        if self.lexical.stamp != self.ids.next_id or len(self.lexical.docs) < self.count():
+            self._rebuild_lexical()
+
+    def shard(self, source: str):
+        """
+        Collection holding the memories of `source`, created on first use.
+        """
+        with self._shards_lock:
+            if source not in self.shards:
+                self.shards[source] = _get_collection(self.client, f"{SHARD_PREFIX}{source}", self.embedding)
+            return self.shards[source]
+
+    def _shard_names(self) -> list[str]:
+        return sorted(name for name in _collection_names(self.client) if name.startswith(SHARD_PREFIX))
+
+    def count(self) -> int:
+        return sum(shard.count() for shard in list(self.shards.values()))
+
+    def _migrate_shards(self):
+        """
+        Split the single pre-sharding "index" collection by source, reusing its embeddings.
+
+        Runs for as long as "index" exists, so an interrupted split is finished on the next boot.
+        """
+        if "index" not in _collection_names(self.client):
+            return
+        legacy = _get_collection(self.client, "index", self.embedding)
+        stored = legacy.get(include=["embeddings", "documents", "metadatas"])
+        if stored["ids"]:
+            log(LogType.system, f"[Memory] Splitting {len(stored['ids'])} internal memories by source...")
+            by_source = {}
+            for i, metadata in enumerate(stored["metadatas"]):
+                by_source.setdefault((metadata or {}).get("source", "self"), []).append(i)
+            batch_size = getattr(self.client, "max_batch_size", 5000)
+            for source, rows in by_source.items():
+                shard = self.shard(source)
+                for start in range(0, len(rows), batch_size):
+                    batch = rows[start:start + batch_size]
+                    shard.upsert(
+                        ids=[stored["ids"][i] for i in batch],
+                        embeddings=[stored["embeddings"][i] for i in batch],
+                        documents=[stored["documents"][i] for i in batch],
+                        metadatas=[stored["metadatas"][i] for i in batch]
+                    )
+        self.client.delete_collection("index")
+
+    def _rebuild_lexical(self):
+        self.lexical.clear()
+        for source, shard in list(self.shards.items()):
+            stored = shard.get(include=["documents"])
+            self.lexical.add(stored["ids"], stored["documents"], [source] * len(stored["ids"]))
+        if self.writer:
+            pending = list(self.writer.pending.items())
+            self.lexical.add(
+                [_id for _id, _ in pending],
+                [document for _, (document, _) in pending],
+                [(metadata or {}).get("source") for _, (_, metadata) in pending]
+            )
+        self.lexical.save(self.ids.next_id)
+
+    def _nearest(self, embeddings: list, source: str) -> list[tuple]:
+        """
+        Closest stored or queued entry of `source` for each embedding, as `(id, similarity)` (or `None`).
+        """
+        results = [self.shard(source).query(query_embeddings=embeddings, n_results=1)]
+        if self.writer and self.writer.pending:
+            results.append(self.writer.scan(embeddings, {"source": source}, n_results=1))
+        combined = _combine_results(*results)
+        return [(ids[0], 1 - distances[0]) if ids else None for ids, distances in zip(combined["ids"], combined["distances"])]
+
+    def _deduplicate(self, content: list, source: str) -> tuple[list, list]:
+        """
+        Split `content` into new entries and `(id, entry)` updates for near-duplicates, per `MEMORY_DEDUP`.
+        """
+        embeddings = np.asarray(self.embedding(content), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+        nearest = self._nearest(embeddings.tolist(), source)
+        threshold = settings.memory_dedup_similarity
+        new, updates, kept = [], {}, []
+        for i, entry in enumerate(content):
+            match = nearest[i][0] if nearest[i] and nearest[i][1] >= threshold else None
+            # Rephrasings within the same batch count too
+            in_batch = bool(kept) and float(np.max(embeddings[kept] @ embeddings[i])) >= threshold
+            if match is None and not in_batch:
+                kept.append(i)
+                new.append(entry)
+            elif match is not None and not in_batch and settings.memory_dedup == "merge" and match not in updates:
+                # Newest phrasing replaces the stored one, keeping its ID
+                updates[match] = entry
+                self.suppressed["merged"] += 1
+            else:
+                self.suppressed["skipped"] += 1
+        return new, list(updates.items())
 
     def add(self, content: list, source: str):
-        for entry in content:
-            self.index.add(ids=[str(self.index.count()+1)], documents=[entry], metadatas=[{"source": source}])
+        if not content:
+            return
+        content = list(content)
+        updates = []
+        if settings.memory_dedup in ("skip", "merge"):
+            content, updates = self._deduplicate(content, source)
+        ids = self.ids.allocate(len(content)) if content else []
+        ids += [_id for _id, _ in updates]
+        content += [entry for _, entry in updates]
+        if not ids:
+            return
+        metadatas = [{"source": source, "created": time.time()}] * len(ids)
+        self.writes[source] = self.writes.get(source, 0) + 1
+        self.lexical.add(ids, content, [source] * len(ids))
+        if self.writer:
+            self.writer.put(ids, content, metadatas)
+        elif updates:
+            self.shard(source).upsert(ids=ids, documents=content, metadatas=metadatas)
+        else:
+            _batched_add(self.client, self.shard(source), ids, content, metadatas)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait for queued writes to reach the collection.
+        """
+        self.access.save()
+        self.lexical.save(self.ids.next_id)
+        return self.writer.flush(timeout) if self.writer else True
     
+    def _vector_search(self, queries: list, source: str) -> dict:
+        # Embed once for both the collection and the unflushed buffer
+        query_embeddings = self.embedding(list(queries))
+        query_results = self.shard(source).query(query_embeddings=query_embeddings, n_results=MAX_PER_QUERY)
+        if self.writer and self.writer.pending:
+            query_results = _combine_results(self.writer.scan(query_embeddings, {"source": source}), query_results)
+        return query_results
+
+    def _confident(self, hits: list) -> bool:
+        """
+        Whether the best lexical hit has every keyword and clearly outscores the runner-up.
+        """
+        return bool(hits) and hits[0][2] == 1 and (len(hits) == 1 or hits[0][1] >= settings.memory_lexical_confidence * hits[1][1])
+
+    def _documents(self, ids: list, source: str) -> dict:
+        documents = self.writer.documents(ids) if self.writer else {}
+        missing = [_id for _id in ids if _id not in documents]
+        if missing:
+            stored = self.shard(source).get(ids=missing, include=["documents"])
+            documents.update(zip(stored["ids"], stored["documents"]))
+        return documents
+
+    def _hybrid_query(self, queries: list, source: str) -> list[list[tuple]]:
+        """
+        Fuse BM25 and vector rankings per query with reciprocal rank fusion.
+        Queries with a confident lexical hit skip the embedding pass entirely.
+        """
+        lexical = [self.lexical.search(query, source, MAX_PER_QUERY) for query in queries]
+        dense = [i for i, hits in enumerate(lexical) if not self._confident(hits)]
+        rankings = [
+            [[_id for _id, _, coverage in hits if coverage == 1 or (i in dense and coverage > 0)]]
+            for i, hits in enumerate(lexical)
+        ]
+        documents = {}
+        if dense:
+            query_results = self._vector_search([queries[i] for i in dense], source)
+            for row, i in enumerate(dense):
+                ranking = []
+                for _id, distance, document in zip(query_results["ids"][row], query_results["distances"][row], query_results["documents"][row]):
+                    if _score(distance) >= MIN_SCORE:
+                        ranking.append(_id)
+                        documents[_id] = document
+                rankings[i].append(ranking)
+
+        fused_rankings = []
+        for query_rankings in rankings:
+            fused = {}
+            for ranking in query_rankings:
+                for rank, _id in enumerate(ranking):
+                    fused[_id] = fused.get(_id, 0.0) + 1 / (RRF_K + rank + 1)
+            fused_rankings.append(sorted(fused, key=fused.get, reverse=True)[:MAX_PER_QUERY])
+        missing = {_id for ranking in fused_rankings for _id in ranking if _id not in documents}
+        documents.update(self._documents(list(missing), source))
+        return [[(_id, documents[_id], True) for _id in ranking if _id in documents] for ranking in fused_rankings]
+
+    def rankings(self, queries: list, source: str) -> list[list[tuple]]:
+        """
+        Results of each query on its own as `(id, document, kept)`, which `query` merges in order.
+        """
+        if settings.memory_retrieval == "hybrid":
+            return self._hybrid_query(list(queries), source)
+        query_results = self._vector_search(queries, source)
+        return [
+            [(_id, document, _score(distance) >= MIN_SCORE) for _id, distance, document in zip(ids, distances, documents)]
+            for ids, distances, documents in zip(query_results["ids"], query_results["distances"], query_results["documents"])
+        ]
+
     def query(self, queries: list, source: str):
-        min_score = 0.5
-        max_per_query = 5
-        get_score = lambda x: round(1 - (x / 2), 3)
-        seen_ids = set()
         memories = []
-        for query in queries:
-            query_results = self.index.query(query_texts=[query], n_results=max_per_query, where={"source": {"$eq": source}})
-            for i in range(len(query_results["ids"][0])):
-                _id = int(query_results["ids"][0][i])
-                if _id not in seen_ids:
-                    seen_ids.add(_id)
-                    score = get_score(query_results["distances"][0][i])
-                    if score >= min_score:
-                        memories.append(query_results["documents"][0][i])
-        if memories:
-            return "\n".join([f"- {memory}" for memory in memories])
+        if queries:
+            memories, returned_ids = _merge_rankings(self.rankings(queries, source))
+            self.access.touch(returned_ids)
+        return _format_memories(memories)
+
+    def _clusters(self, page: dict, now: float) -> list[list[int]]:
+        """
+        Greedily group decayed entries of a page whose embeddings are within `MEMORY_CLUSTER_SIMILARITY` of a seed.
+        """
+        pending = self.writer.pending if self.writer else {}
+        cold = [
+            i for i, _id in enumerate(page["ids"])
+            if _id not in pending and self.access.decay(_id, (page["metadatas"][i] or {}).get("created"), now) < 0.5
+        ]
+        if len(cold) < 2:
+            return []
+        vectors = np.asarray([page["embeddings"][i] for i in cold], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        similarity = vectors @ vectors.T
+        assigned = np.zeros(len(cold), dtype=bool)
+        clusters = []
+        for seed in range(len(cold)):
+            if assigned[seed]:
+                continue
+            members = np.flatnonzero(~assigned & (similarity[seed] >= settings.memory_cluster_similarity))[:settings.memory_cluster_max]
+            if len(members) >= 2:
+                assigned[members] = True
+                clusters.append([cold[m] for m in members])
+        return clusters
+
+    def consolidate(self, sources: list, budget: int = None, page_size: int = 256, stop: threading.Event = None) -> int:
+        """
+        Replace clusters of similar, decayed entries with one summarized memory each.
+
+        Runs incrementally: each call scans one page per source from a persisted cursor and summarizes at most
+        `budget` clusters (`MEMORY_CONSOLIDATION_BUDGET`), returning early once `stop` is set or if loading the
+        summarization model would unload a running server. The originals are moved to the `superseded` collection,
+        tagged with the ID of their summary. Returns the number of clusters consolidated.
+        """
+        if not self._consolidating.acquire(blocking=False):
+            return 0
+        try:
+            return self._consolidate(sources, settings.memory_consolidation_budget if budget is None else budget, page_size, stop)
+        finally:
+            self._consolidating.release()
+
+    def start_consolidation(self, sources: list) -> threading.Event:
+        """
+        Run `consolidate` on a background thread. Set the returned event to stop it after the current summary.
+        """
+        stop = threading.Event()
+        def run():
+            try:
+                self.consolidate(sources, stop=stop)
+            except Exception as e:
+                log(LogType.error, f"[Memory] Consolidation failed: {e}")
+        threading.Thread(target=run, name="memory-consolidation", daemon=True).start()
+        return stop
+
+    def _consolidate(self, sources: list, budget: int, page_size: int, stop: threading.Event) -> int:
+        # Deferred so loading memory doesn't pull in the model API
+        import semantics
+        import server
+        cursors = {}
+        if os.path.isfile(self.consolidation_path):
+            with open(self.consolidation_path, "r", encoding="utf-8") as file:
+                cursors = json.load(file)
+
+        done = 0
+        evicts = False
+        now = time.time()
+        for source in sources:
+            if done >= budget or evicts or (stop and stop.is_set()):
+                break
+            offset = cursors.get(source, 0)
+            shard = self.shard(source)
+            page = shard.get(limit=page_size, offset=offset, include=["embeddings", "documents", "metadatas"])
+            removed = 0
+            for cluster in self._clusters(page, now):
+                if done >= budget or (stop and stop.is_set()):
+                    break
+                if server.would_evict(server.Model.long_context):
+                    log(LogType.system, "[Memory] Skipping consolidation, loading the summarization model would unload a running one.")
+                    evicts = True
+                    break
+                documents = [page["documents"][i] for i in cluster]
+                summary = semantics.summarize(
+                    "memory",
+                    "\n".join(f"- {document}" for document in documents),
+                    extra_inst="The content is a list of related memories. Merge them into one concise memory that keeps every distinct fact."
+                ).strip()
+                if not summary:
+                    continue
+                ids = [page["ids"][i] for i in cluster]
+                _id = self.ids.allocate(1)
+                metadata = [{"source": source, "created": now, "consolidated": len(ids)}]
+                if self.writer:
+                    self.writer.put(_id, [summary], metadata)
+                else:
+                    shard.add(ids=_id, documents=[summary], metadatas=metadata)
+                # Kept in case the summary lost something, written before they leave the shard
+                self.superseded.upsert(
+                    ids=ids,
+                    embeddings=[page["embeddings"][i] for i in cluster],
+                    documents=documents,
+                    metadatas=[{**(page["metadatas"][i] or {}), "superseded_by": _id[0]} for i in cluster]
+                )
+                shard.delete(ids=ids)
+                self.writes[source] = self.writes.get(source, 0) + 1
+                self.access.forget(ids)
+                self.lexical.remove(ids)
+                self.lexical.add(_id, [summary], [source])
+                removed += len(ids)
+                done += 1
+                self.consolidated["clusters"] += 1
+                self.consolidated["entries"] += len(ids)
+            # Wrap around once the end of the source is reached
+            next_offset = offset + len(page["ids"]) - removed
+            cursors[source] = next_offset if len(page["ids"]) == page_size else 0
+
+        write_json_atomic(self.consolidation_path, cursors)
+        self.access.save()
+        self.lexical.save(self.ids.next_id)
+        return done
+
+class MemoryPrefetcher:
+    """
+    Warms a per-session cache of likely `InternalMemory.query` results as soon as a message arrives.
+
+    `prefetch()` runs the store's own retrieval in the background for the queries a search is likely to use (the
+    message and each of its sentences) and caches each query's ranking per source, with the query's embedding.
+    A later `query()` reuses the ranking of a cached query that is the same text, or whose embedding is within
+    `MEMORY_PREFETCH_SIMILARITY` of it, and searches the rest. Rankings of a source are dropped once it's written to.
+    """
+    MAX_PREDICTED = 4
+
+    def __init__(self, store, sources: list, max_entries: int = 256):
+        self.store = store
+        self.sources = sources
+        self.max_entries = max_entries
+        # (source, query): (writes, normalized query embedding, ranking)
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "saved": 0.0}
+        self._query_time = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-prefetch")
+        self._future = None
+
+    def _predict(self, message: str) -> list[str]:
+        sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", message) if sentence.strip()]
+        predicted = [message.strip()]
+        if len(sentences) > 1:
+            predicted.extend(sentences[:self.MAX_PREDICTED - 1])
+        return predicted
+
+    def prefetch(self, message: str):
+        if message and message.strip():
+            self._future = self._pool.submit(self._prefetch, message)
+
+    def _prefetch(self, message: str):
+        try:
+            queries = self._predict(message)
+            for source in self.sources:
+                start = time.perf_counter()
+                self._search(queries, source)
+                self._track_query_time((time.perf_counter() - start) / len(queries))
+        except Exception as e:
+            log(LogType.error, f"[Memory] Prefetch failed: {e}")
+
+    def _embed(self, queries: list) -> np.ndarray:
+        vectors = np.asarray(self.store.embedding(queries), dtype=np.float32)
+        return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+    def _search(self, queries: list, source: str, vectors: np.ndarray = None) -> list:
+        """
+        Search `queries` with the store and cache their rankings.
+        """
+        # Read first, a write landing during the search must invalidate what it returns
+        writes = self.store.writes.get(source, 0)
+        if vectors is None:
+            vectors = self._embed(queries)
+        rankings = self.store.rankings(queries, source)
+        with self._lock:
+            for query, vector, ranking in zip(queries, vectors, rankings):
+                self.entries[(source, query)] = (writes, vector, ranking)
+                self.entries.move_to_end((source, query))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return rankings
+
+    def _cached(self, queries: list, source: str) -> tuple[dict, dict]:
+        """
+        Cached rankings of `queries`, and the embeddings of those that weren't cached under the same text.
+        """
+        writes = self.store.writes.get(source, 0)
+        cached = {}
+        with self._lock:
+            for query in queries:
+                entry = self.entries.get((source, query))
+                if entry is not None and entry[0] == writes:
+                    cached[query] = entry[2]
+            candidates = [entry for key, entry in self.entries.items() if key[0] == source and entry[0] == writes]
+        missing = [query for query in queries if query not in cached]
+        if not missing:
+            return cached, {}
+        vectors = self._embed(missing)
+        if candidates:
+            # Only a query close enough to mean the same thing shares a ranking
+            similarity = vectors @ np.stack([entry[1] for entry in candidates]).T
+            best = similarity.argmax(axis=1)
+            for i, query in enumerate(missing):
+                if similarity[i, best[i]] >= settings.memory_prefetch_similarity:
+                    cached[query] = candidates[best[i]][2]
+        return cached, {query: vector for query, vector in zip(missing, vectors) if query not in cached}
+
+    def query(self, queries: list, source: str) -> str:
+        """
+        Same as `InternalMemory.query`, served from the prefetch cache when possible.
+        """
+        if not queries:
+            return self.store.query(queries, source)
+        queries = [query.strip() for query in queries]
+        unique = list(dict.fromkeys(queries))
+        start = time.perf_counter()
+        cached, missing = self._cached(unique, source)
+        if missing and self._future is not None and not self._future.done():
+            # A prefetch still running may be computing the rest, and is closer to done than a fresh search
+            self._future.result()
+            cached, missing = self._cached(unique, source)
+        if missing:
+            cached.update(zip(missing, self._search(list(missing), source, np.stack(list(missing.values())))))
+        if len(missing) < len(unique):
+            self.stats["hits"] += 1
+            if self._query_time is not None:
+                saved = self._query_time * (len(unique) - len(missing))
+                self.stats["saved"] += max(saved - (time.perf_counter() - start), 0)
         else:
-            return "No relevant memories found!"
+            self.stats["misses"] += 1
+            self._track_query_time((time.perf_counter() - start) / len(missing))
+        memories, returned_ids = _merge_rankings([cached[query] for query in queries])
+        self.store.access.touch(returned_ids)
+        return _format_memories(memories)
+
+    def _track_query_time(self, elapsed: float):
+        # Running average of an uncached search per query, the baseline for time saved
+        self._query_time = elapsed if self._query_time is None else 0.8 * self._query_time + 0.2 * elapsed
+
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return round(self.stats["hits"] / lookups, 3) if lookups else 0.0
@@ -5,6 +5,7 @@ import time
 import re
 import random
 from typing import Literal
+import settings
 
 @register("If `is_rhetorical` is True, sends a one-way message to the user. Otherwise, prompts user for a response")
 def chat(message: str, is_rhetorical: bool = False):
@@ -22,12 +23,14 @@ def chat(message: str, is_rhetorical: bool = False):
 
 @register("Searches your memories of a memory_type")
 def search_memories(queries: list[str], memory_type: Literal["user", "self", "world_knowledge"]):
+    if Session.prefetcher:
+        return Session.prefetcher.query(queries, memory_type.lower())
     memories = Session.internal_memory.query(queries, memory_type.lower())
     return memories
 
 @register("Store information for a given memory_type")
 def store_memories(memory_type: Literal["user", "self", "world_knowledge"], memories: list[str]):
-    Session.internal_memory.add(memories, memory_type)
+    Session.internal_memory.add(memories, memory_type.lower())
     return f"Upserted memories for '{memory_type}'."
 
 @register("Saves your current activity and temporarily shuts you down")
@@ -37,6 +40,12 @@ def shutdown():
 @register("Makes you go idle if the user goes AFK or there is nothing to do")
 def go_idle():
     log(LogType.action, "Going idle. Enter message to resume session.")
+    stop_consolidation = None
+    if settings.memory_consolidation_budget > 0:
+        # Compact old memories while waiting on the user
+        stop_consolidation = Session.internal_memory.start_consolidation(["user", "self", "world_knowledge"])
     response = input("> ")
+    if stop_consolidation:
+        stop_consolidation.set()
     Session.add_event("User", response)
     return "User has returned"
\ No newline at end of file
@@ -1,5 +1,7 @@
-from api import completion, Model, response
-from utils import log, LogType, percent_of_string
+from api import completion, completion_async, gather, Model, response, make_schema, SchemaValue
+from utils import log, LogType, percent_of_string, rand_seed
+from typing import Literal
+import asyncio
 
 def cardinal_to_ordinal(cardinal: int, **kwargs) -> str:
     return completion(
@@ -29,20 +31,8 @@ def cardinal_to_ordinal(cardinal: int, **kwargs) -> str:
         **kwargs
     )
 
-def generate_questions(prompt: str, q_count: int = 5, as_string: bool = False, show_progress: bool = False, **kwargs) -> list | str:
-    """
-    Slow and token-hefty but stable.
-    """
-    questions = []
-    for q in range(q_count):
-        if questions:
-            _questions = "\n".join(questions) + "\n" + f"{q+1}. "
-        else:
-            _questions = "1. "
-            
-        new_question = completion(
-            model=Model.instruct,
-            prompt=f"""
+def _questions_prompt(prompt: str, q_count: int, questions: str) -> str:
+    return f"""
             Logic Task: Ask the given number of most relevant standalone questions focusing on the key elements, related frames, and presuppositions within the Query.
             Use deductive reasoning, pragmatic inference, and individuation.
             Attempt to simulate the scenario of the Query in your head, and observing what happens.
@@ -70,21 +60,78 @@ def generate_questions(prompt: str, q_count: int = 5, as_string: bool = False, s
             Query: {prompt}
             Question count: {q_count}
             Questions:
-            {_questions}""",
-            temperature=kwargs.get("temperature", 0.6),
-            top_p=kwargs.get("top_p", 0.6),
-            min_p=kwargs.get("min_p", 0.6),
-            frequency_penalty=0.3,
-            presence_penalty=0.5,
-            stop=["\n"],
-            **kwargs
+            {questions}"""
+
+def generate_questions(
+    prompt: str,
+    q_count: int = 5,
+    as_string: bool = False,
+    show_progress: bool = False,
+    mode: Literal["sequential", "single", "parallel"] = "sequential",
+    **kwargs
+) -> list | str:
+    """
+    `mode`:
+    - `sequential`: One call per question, each seeing the previous ones. Slow and token-hefty but stable.
+    - `single`: All questions in one schema-constrained call.
+    - `parallel`: One call per question, fanned out across server slots over a shared cached prefix.
+      Questions don't see each other, and this can't be called from inside a running event loop.
+    """
+    params = {
+        "temperature": 0.6,
+        "top_p": 0.6,
+        "min_p": 0.6,
+        "frequency_penalty": 0.3,
+        "presence_penalty": 0.5,
+        **kwargs
+    }
+
+    if mode == "single":
+        content = completion(
+            model=Model.instruct,
+            prompt=_questions_prompt(prompt, q_count, "") + "\n(Answer with a JSON object.)",
+            json_schema=make_schema(questions=SchemaValue.string_list(min_items=q_count, max_items=q_count)),
+            **params
         )
-        
-        questions.append(f"{q+1}. {new_question}")
-        
+        questions = [f"{q+1}. {question}" for q, question in enumerate(content["questions"][:q_count])]
         if show_progress:
-            log(LogType.think, f"[Semantics] Questions ({q+1}/{q_count}): {percent_of_string(new_question, 50)}...")
-        
+            log(LogType.think, f"[Semantics] Questions ({len(questions)}/{q_count})")
+
+    elif mode == "parallel":
+        # Identical prefix for every call, so the server reuses its cached prompt
+        seed = params.pop("seed", None)
+        tasks = [
+            completion_async(
+                model=Model.instruct,
+                prompt=_questions_prompt(prompt, q_count, f"{q+1}. "),
+                **{"stop": ["\n"], "cache_prompt": True, **params, "seed": seed + q if seed is not None else rand_seed()}
+            )
+            for q in range(q_count)
+        ]
+        results = asyncio.run(gather(tasks))
+        questions = [f"{q+1}. {question}" for q, question in enumerate(results)]
+        if show_progress:
+            log(LogType.think, f"[Semantics] Questions ({len(questions)}/{q_count})")
+
+    else:
+        questions = []
+        for q in range(q_count):
+            if questions:
+                _questions = "\n".join(questions) + "\n" + f"{q+1}. "
+            else:
+                _questions = "1. "
+
+            new_question = completion(
+                model=Model.instruct,
+                prompt=_questions_prompt(prompt, q_count, _questions),
+                **{"stop": ["\n"], **params}
+            )
+
+            questions.append(f"{q+1}. {new_question}")
+
+            if show_progress:
+                log(LogType.think, f"[Semantics] Questions ({q+1}/{q_count}): {percent_of_string(new_question, 50)}...")
+
     if as_string:
         return "\n".join(questions)
     else:
@@ -7,9 +7,18 @@ import shutil
 from tqdm import tqdm
 import platform
 import time
+import threading
+import transport
+from functools import lru_cache
+from tokenizer import read_gguf_metadata
     
+# Last model requested through `load`
 current_model = None
-instance = None
+# Running servers keyed by model path
+instances = {}
+# Per-model load count, eviction count, last load time and startup errors
+pool_stats = {}
+_lock = threading.RLock()
 
 class Model:
     core = [settings.core_model, settings.core_size]
@@ -74,41 +83,238 @@ def update():
         except Exception as e:
             log(LogType.warning, f"[Server] Could not download llama.cpp update! ({e})", is_stream=False)
 
-def is_running():
-    return True if instance != None else False
+def is_running(model_path: str = None):
+    """
+    Whether any server (or the server for `model_path`) is up.
+    """
+    if model_path:
+        return model_path in instances and instances[model_path]["process"].poll() is None
+    return any(instance["process"].poll() is None for instance in instances.values())
 
-def close():
-    if is_running():
-        instance.terminate()
-    
-def load(model: Model = Model.core):
-    global current_model, instance
+@lru_cache(maxsize=None)
+def _kv_bytes_per_token(model_path: str) -> int:
+    """
+    Size of one token in the f16 KV cache, from the model's GGUF metadata (0 if it can't be read).
+    """
+    try:
+        metadata = read_gguf_metadata(model_path, prefix="")
+        arch = metadata["general.architecture"]
+        layers = metadata[f"{arch}.block_count"]
+        heads = metadata[f"{arch}.attention.head_count"]
+        kv_heads = metadata.get(f"{arch}.attention.head_count_kv", heads)
+        # Per-layer lists on some architectures
+        heads = max(heads) if isinstance(heads, list) else heads
+        kv_heads = max(kv_heads) if isinstance(kv_heads, list) else kv_heads
+        head_size = metadata[f"{arch}.embedding_length"] // heads
+        key_size = metadata.get(f"{arch}.attention.key_length", head_size)
+        value_size = metadata.get(f"{arch}.attention.value_length", head_size)
+        return layers * kv_heads * (key_size + value_size) * 2
+    except Exception as e:
+        log(LogType.warning, f"[Server] Could not estimate the KV cache size of {os.path.basename(model_path)}, budgeting weights only. ({e})")
+        return 0
+
+def _footprint(model: Model):
+    """
+    Estimated memory used by a server for `model`: its weights plus the KV cache of every parallel slot.
+    """
+    try:
+        weights = os.path.getsize(model[0])
+    except OSError:
+        return 0
+    return weights + _kv_bytes_per_token(model[0]) * model[1] * settings.llama_parallel
+
+def _ram_budget():
+    """
+    `LLAMA_RAM_BUDGET_GB` in bytes, or 75% of physical RAM if it's 0 (no limit if that can't be read).
+    """
+    if settings.llama_ram_budget_gb > 0:
+        return int(settings.llama_ram_budget_gb * 1024 ** 3)
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.75)
+    except (AttributeError, ValueError, OSError):
+        # Windows
+        return 0
+
+def _stop(model_path: str):
+    instance = instances.pop(model_path)
+    instance["process"].terminate()
+    try:
+        instance["process"].wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        instance["process"].kill()
+    instance["log_file"].close()
+
+def _evict_for(model: Model):
+    """
+    Stop least-recently-used servers until `model` fits the server count and RAM budget.
+    """
+    budget = _ram_budget()
+    required = _footprint(model)
+    while instances:
+        in_use = sum(instance["size"] for instance in instances.values())
+        over_count = len(instances) >= settings.llama_max_servers
+        over_budget = budget > 0 and in_use + required > budget
+        if not over_count and not over_budget:
+            break
+        lru = min(instances, key=lambda path: instances[path]["last_used"])
+        log(LogType.system, f"[Server] Unloading {os.path.basename(lru)} to make room for {os.path.basename(model[0])}")
+        _stop(lru)
+        pool_stats[lru]["evictions"] += 1
+
+def would_evict(model: Model):
+    """
+    Whether loading `model` now would stop another running server to make room for it.
+    """
+    if is_running(model[0]):
+        return False
+    others = {path: instance for path, instance in list(instances.items()) if path != model[0]}
+    if not any(instance["process"].poll() is None for instance in others.values()):
+        return False
+    budget = _ram_budget()
+    in_use = sum(instance["size"] for instance in others.values())
+    return len(others) >= settings.llama_max_servers or (budget > 0 and in_use + _footprint(model) > budget)
+
+def _free_port():
+    used = {instance["port"] for instance in instances.values()}
+    port = settings.llama_port
+    while port in used:
+        port += 1
+    return port
+
+def close(model_path: str = None):
+    """
+    Stop every server, or only the one serving `model_path`.
+    """
+    if model_path:
+        if model_path in instances:
+            _stop(model_path)
+        return
+    for path in list(instances):
+        _stop(path)
+    # Pooled sockets point at the old processes
+    transport.close()
+
+def load(model: Model = Model.core) -> str:
+    """
+    Make sure a server for `model` is running and ready, and return its host URL.
+
+    Blocks until the model has finished loading.
+
+    Servers for other models are kept alive (up to `LLAMA_MAX_SERVERS` and `LLAMA_RAM_BUDGET_GB`).
+    """
+    global current_model
     if settings.llama_update():
         if is_running():
             close()
         update()
         time.sleep(1)
-        load(model)
-    
+        return load(model)
+
+    with _lock:
+        current_model = model[0]
+        if model[0] in instances and not is_running(model[0]):
+            log(LogType.warning, f"[Server] Server for {os.path.basename(model[0])} exited, restarting...")
+            instances.pop(model[0])
+        if model[0] in instances:
+            instance = instances[model[0]]
+            instance["last_used"] = time.monotonic()
+            spawned = False
+        else:
+            instance = _spawn(model)
+            spawned = True
+
+    # Wait outside the lock so servers that are already up stay usable
+    if spawned:
+        _wait_ready(model[0], instance)
+    else:
+        instance["ready"].wait()
+    if instance["error"]:
+        raise RuntimeError(instance["error"])
+    return f"{settings.llama_host}:{instance['port']}"
+
+def _spawn(model: Model):
+    _evict_for(model)
+    port = _free_port()
     server_ex = llama_binary("llama-server")
     args = [
             os.path.join(get_dir("llamacpp"), server_ex),
             "-m", model[0],
             "--mlock",
-            "--port", str(settings.llama_port),
+            "--port", str(port),
             "-v",
-            "-c", str(model[1])
+            # Each parallel slot gets the full context size
+            "-c", str(model[1] * settings.llama_parallel),
+            "-np", str(settings.llama_parallel)
         ]
-    
+
+    if settings.llama_slot_persistence:
+        args.extend(["--slot-save-path", str(get_dir("slots"))])
     if settings.llama_flash_attention:
         args.append("-fa")
     if settings.llama_n_gpu_layers > 0:
         args.extend(["-ngl", str(settings.llama_n_gpu_layers)])
 
-    # Restart server if new model
-    if model[0] != current_model:
-        if is_running():
-            close()
-        current_model = model[0]
-        exec = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-        instance = exec
+    log_path = get_dir("logs") / f"llama-server-{port}.log"
+    log_file = open(log_path, "w", encoding="utf-8", errors="replace")
+    exec = subprocess.Popen(args, stdout=log_file, stderr=subprocess.STDOUT)
+    instance = {
+        "process": exec,
+        "port": port,
+        "size": _footprint(model),
+        "last_used": time.monotonic(),
+        "started": time.monotonic(),
+        "log_path": log_path,
+        "log_file": log_file,
+        "ready": threading.Event(),
+        "error": None
+    }
+    instances[model[0]] = instance
+    stats = pool_stats.setdefault(model[0], {"loads": 0, "evictions": 0, "load_time": 0.0, "errors": []})
+    stats["loads"] += 1
+    return instance
+
+def _log_tail(path, lines: int = 20):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            return "".join(file.readlines()[-lines:])
+    except OSError:
+        return ""
+
+def _wait_ready(model_path: str, instance: dict):
+    """
+    Poll the server's health endpoint with backoff until the model is loaded.
+
+    Records the load time, or the startup error if the process dies or never becomes ready.
+    """
+    url = f"{settings.llama_host}:{instance['port']}/health"
+    deadline = instance["started"] + settings.llama_load_timeout
+    delay = 0.05
+    error = None
+    while True:
+        if instance["process"].poll() is not None:
+            error = f"llama-server exited with code {instance['process'].returncode}:\n{_log_tail(instance['log_path'])}"
+            break
+        try:
+            if transport.get(url, timeout=(1, 5)).status_code == 200:
+                break
+        except Exception:
+            # Not listening yet
+            pass
+        if time.monotonic() > deadline:
+            error = f"llama-server did not become ready within {settings.llama_load_timeout}s:\n{_log_tail(instance['log_path'])}"
+            break
+        time.sleep(delay)
+        delay = min(delay * 1.5, 1.0)
+
+    stats = pool_stats[model_path]
+    if error:
+        instance["error"] = f"[Server] Could not load {os.path.basename(model_path)}! {error}"
+        stats["errors"].append(instance["error"])
+        log(LogType.error, instance["error"])
+        with _lock:
+            if instances.get(model_path) is instance:
+                _stop(model_path)
+    else:
+        stats["load_time"] = round(time.monotonic() - instance["started"], 3)
+        log(LogType.system, f"[Server] Loaded {os.path.basename(model_path)} in {stats['load_time']}s")
+    instance["ready"].set()
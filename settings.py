@@ -17,6 +17,15 @@ CONFIG_TEMPLATE = [
     "# Default: http//localhost, 8080",
     "LLAMA_HOST='http://localhost'",
     "LLAMA_PORT=8080",
+    "# Keep-alive connection pool and request timeouts (seconds).",
+    "LLAMA_POOL_SIZE=4",
+    "LLAMA_CONNECT_TIMEOUT=5",
+    "LLAMA_READ_TIMEOUT=600",
+    "# Memory cap (MB) for cached tokenizer results.",
+    "TOKEN_CACHE_MB=16",
+    "# Tokenize in-process from the GGUF vocabulary instead of over HTTP.",
+    "# Verify with `python tokenizer.py` before enabling.",
+    "LOCAL_TOKENIZER=False",
     "",
     "# Auto-update llama.cpp binaries on runtime.",
     "LLAMA_AUTO_UPDATE=True",
@@ -24,6 +33,16 @@ CONFIG_TEMPLATE = [
     "LLAMA_FLASH_ATTENTION=True",
     "# How many layers to offload to GPU",
     "LLAMA_N_GPU_LAYERS=50",
+    "# Save the core KV cache per persona on shutdown and restore it on boot.",
+    "LLAMA_SLOT_PERSISTENCE=True",
+    "# Keep up to this many models loaded at once (one llama-server each, on consecutive ports).",
+    "LLAMA_MAX_SERVERS=2",
+    "# Unload least-recently-used models past this RAM budget in GB, counting weights and KV cache (0 = 75% of RAM).",
+    "LLAMA_RAM_BUDGET_GB=0",
+    "# Seconds to wait for a model to finish loading.",
+    "LLAMA_LOAD_TIMEOUT=300",
+    "# Parallel request slots per server (each gets the full context size).",
+    "LLAMA_PARALLEL=1",
     "",
     "# Name of default Persona",
     "DEFAULT_PERSONA='MIST'",
@@ -48,11 +67,51 @@ CONFIG_TEMPLATE = [
     "CORE_PRESENCE_PENALTY = 0.4",
     "# Disable any given word/string. Useful to handle hallucinations.",
     "CORE_LOGIT_BIAS = []",
+    "# Prompt layout: 'stable' keeps the prompt prefix fixed between evictions to reuse the KV cache, 'legacy' evicts one cycle at a time.",
+    "PROMPT_LAYOUT='stable'",
+    "# Share of the core context freed per eviction in the 'stable' layout.",
+    "PROMPT_EVICTION_RATIO=0.5",
+    "# Stream core responses, running each function as soon as it's generated (ignored when overriding responses).",
+    "CORE_STREAMING=False",
     "",
     "# Instruct model:",
     "INSTRUCT_MODEL='GGUF_PATH'",
     "INSTRUCT_SIZE=4096",
     "",
+    "# Embedding backend: 'torch', 'onnx' or 'onnx-int8' (ONNX Runtime, int8 quantized weights).",
+    "EMBEDDING_BACKEND='torch'",
+    "# Share one embedding process (Unix socket) between all MIST processes instead of loading models per process.",
+    "EMBEDDING_SERVICE=False",
+    "# Socket path for the embedding service ('' = embeddings/service.sock).",
+    "EMBEDDING_SOCKET=''",
+    "# Memory vector store: 'chroma' or 'numpy' (brute force, fastest for up to ~100k memories per persona).",
+    "MEMORY_BACKEND='chroma'",
+    "# On-disk embedding cache size per embedding model, in MB (0 = disabled).",
+    "EMBEDDING_CACHE_MB=128",
+    "# Memory store startup: 'background' (load while booting), 'lazy' (load on first use) or 'eager'.",
+    "MEMORY_INIT='background'",
+    "# Queue memory writes in a journal and index them on a background thread.",
+    "MEMORY_WRITE_BEHIND=True",
+    "# Near-duplicate internal memories: 'skip', 'merge' (replace the stored entry) or 'off'.",
+    "MEMORY_DEDUP='skip'",
+    "# Cosine similarity above which a new memory counts as a duplicate of its nearest neighbour.",
+    "MEMORY_DEDUP_SIMILARITY=0.95",
+    "# Internal memory retrieval: 'hybrid' (BM25 + embeddings, rank fused) or 'vector'.",
+    "MEMORY_RETRIEVAL='hybrid'",
+    "# Skip embeddings when the best keyword match beats the next one by this factor.",
+    "MEMORY_LEXICAL_CONFIDENCE=1.5",
+    "# Search likely memories for each user message in the background, reused by searches with an equivalent query.",
+    "MEMORY_PREFETCH=False",
+    "# Cosine similarity above which a search reuses the results prefetched for another query.",
+    "MEMORY_PREFETCH_SIMILARITY=0.97",
+    "# Internal memories decay by half every N days without being recalled.",
+    "MEMORY_HALF_LIFE_DAYS=30",
+    "# Summarize clusters of decayed, similar memories while idle (max summaries per run, 0 = disabled).",
+    "# Skipped if loading the summarization model would unload a running one. Originals are kept, marked superseded.",
+    "MEMORY_CONSOLIDATION_BUDGET=0",
+    "MEMORY_CLUSTER_SIMILARITY=0.8",
+    "MEMORY_CLUSTER_MAX=8",
+    "",
     "# Disable modules using string list.",
     "DISABLED_MODULES=[]",
     "",
@@ -79,9 +138,19 @@ disable_splash = literal_eval(config.get("DISABLE_SPLASH"))
 llama_build_type = config.get("LLAMA_BUILD_TYPE").replace(".zip", "")
 llama_host = config.get("LLAMA_HOST")
 llama_port = literal_eval(config.get("LLAMA_PORT"))
+llama_pool_size = literal_eval(config.get("LLAMA_POOL_SIZE", "4"))
+llama_connect_timeout = literal_eval(config.get("LLAMA_CONNECT_TIMEOUT", "5"))
+llama_read_timeout = literal_eval(config.get("LLAMA_READ_TIMEOUT", "600"))
+token_cache_mb = literal_eval(config.get("TOKEN_CACHE_MB", "16"))
+local_tokenizer = literal_eval(config.get("LOCAL_TOKENIZER", "False"))
 llama_auto_update = literal_eval(config.get("LLAMA_AUTO_UPDATE"))
 llama_flash_attention = literal_eval(config.get("LLAMA_FLASH_ATTENTION"))
 llama_n_gpu_layers  = literal_eval(config.get("LLAMA_N_GPU_LAYERS"))
+llama_slot_persistence = literal_eval(config.get("LLAMA_SLOT_PERSISTENCE", "True"))
+llama_max_servers = literal_eval(config.get("LLAMA_MAX_SERVERS", "2"))
+llama_ram_budget_gb = literal_eval(config.get("LLAMA_RAM_BUDGET_GB", "0"))
+llama_load_timeout = literal_eval(config.get("LLAMA_LOAD_TIMEOUT", "300"))
+llama_parallel = literal_eval(config.get("LLAMA_PARALLEL", "1"))
 
 default_persona = config.get("DEFAULT_PERSONA")
 override_responses = literal_eval(config.get("OVERRIDE_RESPONSES"))
@@ -97,10 +166,31 @@ core_min_p = literal_eval(config.get("CORE_MIN_P"))
 core_frequency_penalty = literal_eval(config.get("CORE_FREQUENCY_PENALTY"))
 core_presence_penalty = literal_eval(config.get("CORE_PRESENCE_PENALTY"))
 core_logit_bias = literal_eval(config.get("CORE_LOGIT_BIAS"))
+prompt_layout = config.get("PROMPT_LAYOUT", "stable")
+prompt_eviction_ratio = literal_eval(config.get("PROMPT_EVICTION_RATIO", "0.5"))
+core_streaming = literal_eval(config.get("CORE_STREAMING", "False"))
 
 instruct_model = config.get("INSTRUCT_MODEL")
 instruct_size = literal_eval(config.get("INSTRUCT_SIZE"))
 
+embedding_backend = config.get("EMBEDDING_BACKEND", "torch")
+memory_backend = config.get("MEMORY_BACKEND", "chroma")
+embedding_service = literal_eval(config.get("EMBEDDING_SERVICE", "False"))
+embedding_socket = config.get("EMBEDDING_SOCKET", "")
+embedding_cache_mb = literal_eval(config.get("EMBEDDING_CACHE_MB", "128"))
+memory_init = config.get("MEMORY_INIT", "background")
+memory_write_behind = literal_eval(config.get("MEMORY_WRITE_BEHIND", "True"))
+memory_dedup = config.get("MEMORY_DEDUP", "skip")
+memory_dedup_similarity = literal_eval(config.get("MEMORY_DEDUP_SIMILARITY", "0.95"))
+memory_retrieval = config.get("MEMORY_RETRIEVAL", "hybrid")
+memory_lexical_confidence = literal_eval(config.get("MEMORY_LEXICAL_CONFIDENCE", "1.5"))
+memory_prefetch = literal_eval(config.get("MEMORY_PREFETCH", "False"))
+memory_prefetch_similarity = literal_eval(config.get("MEMORY_PREFETCH_SIMILARITY", "0.97"))
+memory_half_life_days = literal_eval(config.get("MEMORY_HALF_LIFE_DAYS", "30"))
+memory_consolidation_budget = literal_eval(config.get("MEMORY_CONSOLIDATION_BUDGET", "0"))
+memory_cluster_similarity = literal_eval(config.get("MEMORY_CLUSTER_SIMILARITY", "0.8"))
+memory_cluster_max = literal_eval(config.get("MEMORY_CLUSTER_MAX", "8"))
+
 disabled_modules = literal_eval(config.get("DISABLED_MODULES"))
 llama_latest_build = config.get("LLAMA_LATEST_BUILD")
 llama_last_check = config.get("LLAMA_LAST_CHECK")
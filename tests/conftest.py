@@ -0,0 +1,5 @@
+import sys
+import os
+
+# Modules live at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("requests")
+pytest.importorskip("chromadb")
+
+import settings
+import server
+import core
+
+class RunningProcess:
+    def poll(self):
+        return None
+
+@pytest.fixture
+def saves(monkeypatch):
+    saved = []
+    monkeypatch.setattr(core, "save_slot", saved.append)
+    monkeypatch.setattr(core.Session, "slot_file", "persona-model-0123456789abcdef.bin")
+    return saved
+
+def test_save_slot_skips_an_evicted_core(saves, monkeypatch):
+    # Evicted from the pool to make room for another model
+    monkeypatch.setattr(server, "instances", {})
+    core.Session._save_slot()
+    assert saves == []
+
+def test_save_slot_saves_a_running_core(saves, monkeypatch):
+    monkeypatch.setattr(server, "instances", {settings.core_model: {"process": RunningProcess()}})
+    core.Session._save_slot()
+    assert saves == ["persona-model-0123456789abcdef.bin"]
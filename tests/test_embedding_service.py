@@ -0,0 +1,34 @@
+import threading
+import socket
+import time
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("numpy")
+
+import embedding_service
+
+def test_serve_exits_when_a_listener_answers(tmp_path):
+    socket_path = str(tmp_path / "service.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+    try:
+        # Returns instead of unlinking the live socket
+        embedding_service.EmbeddingServer(socket_path).serve()
+        assert embedding_service._listening(socket_path)
+    finally:
+        listener.close()
+
+def test_serve_replaces_a_stale_socket(tmp_path):
+    socket_path = str(tmp_path / "service.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    assert not embedding_service._listening(socket_path)
+    server = embedding_service.EmbeddingServer(socket_path)
+    threading.Thread(target=server.serve, daemon=True).start()
+    deadline = time.perf_counter() + 5
+    while not embedding_service._listening(socket_path):
+        assert time.perf_counter() < deadline
+        time.sleep(0.05)
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("chromadb")
+np = pytest.importorskip("numpy")
+
+import embeddings
+
+class CountingEmbedding:
+    def __init__(self, dim: int = 8):
+        self.dim = dim
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [np.full(self.dim, len(text) + 0.1, dtype=np.float32) for text in texts]
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings, "get_dir", lambda folder: tmp_path / folder)
+    (tmp_path / "embeddings/cache/test").mkdir(parents=True)
+    return tmp_path
+
+def test_misses_beyond_capacity_are_returned_uncached(cache_dir):
+    function = CountingEmbedding()
+    # Room for 4 float16 vectors of 8 dimensions
+    cache = embeddings.CachedEmbeddingFunction(function, "test", max_mb=4 * 8 * 2 / 1024 / 1024)
+    texts = [f"text {'x' * n}" for n in range(10)]
+    vectors = cache(texts)
+    assert cache.capacity == 4
+    assert len(vectors) == len(texts)
+    for text, vector in zip(texts, vectors):
+        assert vector == pytest.approx([len(text) + 0.1] * 8, abs=1e-2)
+    assert cache.stats()["entries"] == 4
+    # The entries written by the call are still cached
+    assert cache(texts[:4]) == vectors[:4]
+    assert len(function.calls) == 1
+
+def test_lookup_checks_the_key_of_a_reused_slot(cache_dir):
+    max_mb = 2 * 8 * 2 / 1024 / 1024
+    first = embeddings.CachedEmbeddingFunction(CountingEmbedding(), "test", max_mb=max_mb)
+    second = embeddings.CachedEmbeddingFunction(CountingEmbedding(), "test", max_mb=max_mb)
+    alpha = first(["alpha"])[0]
+    # Evicts "alpha" from the shared slots, which `first` still has a hint for
+    second(["beta!", "gamma!!"])
+    assert first(["alpha"])[0] == alpha
+    assert first.stats()["misses"] == 2
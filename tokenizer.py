@@ -0,0 +1,348 @@
+import struct
+import heapq
+import os
+import re
+import threading
+from array import array
+from functools import lru_cache
+from utils import log, LogType
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# GGUF metadata value types
+GGUF_UINT8, GGUF_INT8, GGUF_UINT16, GGUF_INT16 = 0, 1, 2, 3
+GGUF_UINT32, GGUF_INT32, GGUF_FLOAT32, GGUF_BOOL = 4, 5, 6, 7
+GGUF_STRING, GGUF_ARRAY, GGUF_UINT64, GGUF_INT64, GGUF_FLOAT64 = 8, 9, 10, 11, 12
+
+_SCALARS = {
+    GGUF_UINT8: ("<B", 1),
+    GGUF_INT8: ("<b", 1),
+    GGUF_UINT16: ("<H", 2),
+    GGUF_INT16: ("<h", 2),
+    GGUF_UINT32: ("<I", 4),
+    GGUF_INT32: ("<i", 4),
+    GGUF_FLOAT32: ("<f", 4),
+    GGUF_BOOL: ("<?", 1),
+    GGUF_UINT64: ("<Q", 8),
+    GGUF_INT64: ("<q", 8),
+    GGUF_FLOAT64: ("<d", 8)
+}
+
+_ARRAY_CODES = {
+    GGUF_UINT8: "B", GGUF_INT8: "b", GGUF_UINT16: "H", GGUF_INT16: "h",
+    GGUF_UINT32: "I", GGUF_INT32: "i", GGUF_FLOAT32: "f",
+    GGUF_UINT64: "Q", GGUF_INT64: "q", GGUF_FLOAT64: "d"
+}
+
+# llama.cpp token types
+TOKEN_NORMAL, TOKEN_UNKNOWN, TOKEN_CONTROL, TOKEN_USER_DEFINED, TOKEN_UNUSED, TOKEN_BYTE = 1, 2, 3, 4, 5, 6
+
+# Pre-tokenizer splits, as used by llama.cpp for each `tokenizer.ggml.pre`
+PRE_TOKENIZERS = {
+    "default": r"'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)",
+    "llama3": r"(?:'[sS]|'[tT]|'[rR][eE]|'[vV][eE]|'[mM]|'[lL][lL]|'[dD])|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+",
+    "qwen2": r"(?:'[sS]|'[tT]|'[rR][eE]|'[vV][eE]|'[mM]|'[lL][lL]|'[dD])|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+}
+PRE_TOKENIZERS["llama-bpe"] = PRE_TOKENIZERS["llama3"]
+PRE_TOKENIZERS["gpt-2"] = PRE_TOKENIZERS["default"]
+
+# Pre-tokenizers that emit whole words found in the vocab without merging
+IGNORE_MERGES = {"llama3", "llama-bpe"}
+
+PARITY_SAMPLES = [
+    "Hello world!",
+    "  leading and trailing spaces  ",
+    "Line one\nLine two\n\n\tTabbed",
+    "Numbers: 1234567 3.14159 -42",
+    "Emoji and unicode: 😲🤔 naïve café Ω",
+    "{\"cycle_1\": {\"events\": [], \"cognitive_response\": ",
+    "don't won't I'LL we've",
+    "<|eot_id|> special tokens </s>"
+]
+
+def _read_string(file) -> str:
+    (length,) = struct.unpack("<Q", file.read(8))
+    return file.read(length).decode("utf-8", errors="replace")
+
+def _read_value(file, value_type: int):
+    if value_type == GGUF_STRING:
+        return _read_string(file)
+    if value_type == GGUF_ARRAY:
+        (elem_type,) = struct.unpack("<I", file.read(4))
+        (count,) = struct.unpack("<Q", file.read(8))
+        if elem_type in _ARRAY_CODES:
+            values = array(_ARRAY_CODES[elem_type])
+            values.frombytes(file.read(values.itemsize * count))
+            return values.tolist()
+        if elem_type == GGUF_BOOL:
+            return [bool(b) for b in file.read(count)]
+        return [_read_value(file, elem_type) for _ in range(count)]
+    fmt, size = _SCALARS[value_type]
+    return struct.unpack(fmt, file.read(size))[0]
+
+def read_gguf_metadata(path: str, prefix: str = None) -> dict:
+    """
+    Read the metadata key-values from a GGUF file without touching tensor data.
+
+    `prefix`: Only keep keys starting with this string (e.g: `tokenizer.`).
+    """
+    metadata = {}
+    with open(path, "rb") as file:
+        if file.read(4) != b"GGUF":
+            raise ValueError(f"{path} is not a GGUF file")
+        (version,) = struct.unpack("<I", file.read(4))
+        if version == 1:
+            _, kv_count = struct.unpack("<II", file.read(8))
+        else:
+            _, kv_count = struct.unpack("<QQ", file.read(16))
+        for _ in range(kv_count):
+            key = _read_string(file)
+            (value_type,) = struct.unpack("<I", file.read(4))
+            value = _read_value(file, value_type)
+            if prefix is None or key.startswith(prefix) or key == "general.architecture":
+                metadata[key] = value
+    return metadata
+
+@lru_cache(maxsize=1)
+def _bytes_to_unicode() -> dict:
+    """GPT-2 byte-level mapping of raw bytes to printable characters."""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return {b: chr(c) for b, c in zip(bs, cs)}
+
+class GGUFTokenizer:
+    """
+    In-process tokenizer built from the vocabulary stored in a GGUF file.
+
+    Mirrors llama-server's `/tokenize` (no BOS, special tokens parsed) and `/detokenize`.
+    Supports SentencePiece (`llama`) and byte-level BPE (`gpt2`) vocabularies.
+    """
+    def __init__(self, model_path: str):
+        meta = read_gguf_metadata(model_path, prefix="tokenizer.")
+        self.model_path = model_path
+        self.kind = meta.get("tokenizer.ggml.model", "llama")
+        if self.kind not in ["llama", "gpt2"]:
+            raise ValueError(f"Unsupported tokenizer type '{self.kind}'")
+
+        self.tokens = meta["tokenizer.ggml.tokens"]
+        self.scores = meta.get("tokenizer.ggml.scores") or [0.0] * len(self.tokens)
+        self.types = meta.get("tokenizer.ggml.token_type") or [TOKEN_NORMAL] * len(self.tokens)
+        self.vocab = {token: i for i, token in enumerate(self.tokens)}
+        self.unk_id = meta.get("tokenizer.ggml.unknown_token_id", self.vocab.get("<unk>"))
+        self.add_space_prefix = meta.get("tokenizer.ggml.add_space_prefix", self.kind == "llama")
+
+        specials = [
+            token for token, token_type in zip(self.tokens, self.types)
+            if token_type in [TOKEN_CONTROL, TOKEN_USER_DEFINED] and token
+        ]
+        specials.sort(key=len, reverse=True)
+        self._special_split = re.compile("(" + "|".join(re.escape(s) for s in specials) + ")") if specials else None
+
+        if self.kind == "gpt2":
+            if regex is None:
+                raise ImportError("The `regex` package is required for BPE tokenization")
+            pre = meta.get("tokenizer.ggml.pre", "default")
+            # Mirrors `server.override_tokenizer`
+            if pre == "default" and ("llama-3" in model_path.lower() or "llama3" in model_path.lower()):
+                pre = "llama3"
+            if pre not in PRE_TOKENIZERS:
+                log(LogType.warning, f"[Tokenizer] Unknown pre-tokenizer '{pre}', using default. Run a parity check!")
+                pre = "default"
+            self.pre = pre
+            self._pre_split = regex.compile(PRE_TOKENIZERS[pre])
+            self._ignore_merges = pre in IGNORE_MERGES
+            self._byte_encoder = _bytes_to_unicode()
+            self._byte_decoder = {v: k for k, v in self._byte_encoder.items()}
+            self.merge_ranks = {}
+            for rank, merge in enumerate(meta.get("tokenizer.ggml.merges", [])):
+                left, _, right = merge.partition(" ")
+                self.merge_ranks[(left, right)] = rank
+        else:
+            self.pre = None
+
+    def _fragments(self, text: str):
+        """Split on special tokens, yielding (is_special, fragment)."""
+        if self._special_split is None:
+            yield False, text
+            return
+        for i, part in enumerate(self._special_split.split(text)):
+            if part:
+                yield i % 2 == 1, part
+
+    def _spm(self, text: str) -> list[int]:
+        if not text:
+            return []
+        symbols = list(text)
+        prev = list(range(-1, len(symbols) - 1))
+        nxt = list(range(1, len(symbols) + 1))
+        nxt[-1] = -1
+        queue = []
+
+        def push(left: int, right: int):
+            if left == -1 or right == -1:
+                return
+            merged = symbols[left] + symbols[right]
+            token_id = self.vocab.get(merged)
+            if token_id is not None:
+                heapq.heappush(queue, (-self.scores[token_id], left, merged, right))
+
+        for i in range(len(symbols) - 1):
+            push(i, i + 1)
+
+        while queue:
+            _, left, merged, right = heapq.heappop(queue)
+            # Skip stale bigrams
+            if not symbols[left] or not symbols[right] or symbols[left] + symbols[right] != merged or nxt[left] != right:
+                continue
+            symbols[left] = merged
+            symbols[right] = ""
+            nxt[left] = nxt[right]
+            if nxt[right] != -1:
+                prev[nxt[right]] = left
+            push(prev[left], left)
+            push(left, nxt[left])
+
+        ids = []
+        i = 0
+        while i != -1:
+            symbol = symbols[i]
+            token_id = self.vocab.get(symbol)
+            if token_id is not None:
+                ids.append(token_id)
+            else:
+                for byte in symbol.encode("utf-8"):
+                    byte_id = self.vocab.get(f"<0x{byte:02X}>")
+                    ids.append(byte_id if byte_id is not None else self.unk_id)
+            i = nxt[i]
+        return ids
+
+    def _bpe_word(self, word: str) -> list[int]:
+        if self._ignore_merges and word in self.vocab:
+            return [self.vocab[word]]
+        symbols = list(word)
+        while len(symbols) > 1:
+            best = None
+            for i in range(len(symbols) - 1):
+                rank = self.merge_ranks.get((symbols[i], symbols[i + 1]))
+                if rank is not None and (best is None or rank < best[0]):
+                    best = (rank, i)
+            if best is None:
+                break
+            pair = (symbols[best[1]], symbols[best[1] + 1])
+            merged = []
+            i = 0
+            while i < len(symbols):
+                if i < len(symbols) - 1 and (symbols[i], symbols[i + 1]) == pair:
+                    merged.append(symbols[i] + symbols[i + 1])
+                    i += 2
+                else:
+                    merged.append(symbols[i])
+                    i += 1
+            symbols = merged
+        ids = []
+        for symbol in symbols:
+            token_id = self.vocab.get(symbol)
+            if token_id is not None:
+                ids.append(token_id)
+            else:
+                for char in symbol:
+                    ids.append(self.vocab.get(char, self.unk_id))
+        return ids
+
+    def encode(self, text: str) -> list[int]:
+        ids = []
+        is_prev_special = True
+        for is_special, fragment in self._fragments(text):
+            if is_special:
+                ids.append(self.vocab[fragment])
+                is_prev_special = True
+                continue
+            if self.kind == "llama":
+                if self.add_space_prefix and is_prev_special:
+                    fragment = " " + fragment
+                ids.extend(self._spm(fragment.replace(" ", "▁")))
+            else:
+                for word in self._pre_split.findall(fragment):
+                    encoded = "".join(self._byte_encoder[b] for b in word.encode("utf-8"))
+                    ids.extend(self._bpe_word(encoded))
+            is_prev_special = False
+        return ids
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def _piece_bytes(self, token_id: int) -> bytes:
+        token = self.tokens[token_id]
+        token_type = self.types[token_id]
+        if token_type in [TOKEN_CONTROL, TOKEN_USER_DEFINED, TOKEN_UNKNOWN]:
+            return token.encode("utf-8")
+        if self.kind == "llama":
+            if token_type == TOKEN_BYTE:
+                return bytes([int(token[3:-1], 16)])
+            return token.replace("▁", " ").encode("utf-8")
+        return bytes(self._byte_decoder.get(char, ord("?")) for char in token)
+
+    def decode(self, tokens: list[int]) -> str:
+        return b"".join(self._piece_bytes(t) for t in tokens).decode("utf-8", errors="replace")
+
+    def pieces(self, tokens: list[int]) -> list[str]:
+        return [self._piece_bytes(t).decode("utf-8", errors="replace") for t in tokens]
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+def get(model_path: str) -> GGUFTokenizer:
+    """
+    Return the cached tokenizer for a GGUF file, reading its vocabulary on first use.
+    """
+    with _tokenizers_lock:
+        if model_path not in _tokenizers:
+            if not os.path.isfile(model_path):
+                raise FileNotFoundError(f"GGUF file not found: {model_path}")
+            _tokenizers[model_path] = GGUFTokenizer(model_path)
+        return _tokenizers[model_path]
+
+def parity_check(samples: list[str] = None, model = None) -> list[dict]:
+    """
+    Compare the local tokenizer against llama-server's `/tokenize` endpoint.
+
+    Returns a list of mismatches (empty if tokenization is identical).
+    """
+    import api
+    import server
+    import transport
+    model = model or server.Model.core
+    host = server.load(model)
+    local = get(model[0])
+    mismatches = []
+    for sample in samples or PARITY_SAMPLES:
+        remote_ids = transport.post(host + api.tokenize_endpoint, json={"content": sample}).json()["tokens"]
+        local_ids = local.encode(sample)
+        if local_ids != remote_ids:
+            mismatches.append({"content": sample, "local": local_ids, "server": remote_ids})
+        remote_text = transport.post(host + api.detokenize_endpoint, json={"tokens": remote_ids}).json()["content"]
+        local_text = local.decode(remote_ids)
+        if local_text != remote_text:
+            mismatches.append({"content": sample, "local": local_text, "server": remote_text})
+    return mismatches
+
+if __name__ == "__main__":
+    import server
+    try:
+        mismatches = parity_check()
+        if mismatches:
+            for mismatch in mismatches:
+                log(LogType.warning, f"[Tokenizer] Mismatch for {mismatch['content']!r}:\nLocal:  {mismatch['local']}\nServer: {mismatch['server']}")
+        else:
+            log(LogType.system, f"[Tokenizer] Local tokenizer matches llama-server on {len(PARITY_SAMPLES)} samples.")
+    finally:
+        server.close()
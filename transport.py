@@ -0,0 +1,82 @@
+import settings
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+
+# Shared keep-alive session for every llama-server call.
+_session = None
+_adapter = None
+_lock = threading.Lock()
+# Counts carried over from sessions that were closed
+_closed_totals = {"requests": 0, "connections": 0}
+
+def _timeout():
+    return (settings.llama_connect_timeout, settings.llama_read_timeout)
+
+def session() -> requests.Session:
+    """
+    Return the shared pooled session, creating it on first use.
+    """
+    global _session, _adapter
+    with _lock:
+        if _session is None:
+            # Enough connections to keep every server slot busy
+            pool_size = max(settings.llama_pool_size, settings.llama_parallel)
+            _adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                pool_block=True
+            )
+            _session = requests.Session()
+            _session.mount("http://", _adapter)
+            _session.mount("https://", _adapter)
+        return _session
+
+def post(url: str, json: dict = None, stream: bool = False, timeout=None) -> requests.Response:
+    return session().post(url, json=json, stream=stream, timeout=timeout or _timeout())
+
+def get(url: str, timeout=None) -> requests.Response:
+    return session().get(url, timeout=timeout or _timeout())
+
+def _pool_counts():
+    requests_sent = 0
+    connections_opened = 0
+    if _adapter is not None:
+        pools = _adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+    return requests_sent, connections_opened
+
+def close():
+    global _session, _adapter
+    with _lock:
+        if _session is not None:
+            requests_sent, connections_opened = _pool_counts()
+            _closed_totals["requests"] += requests_sent
+            _closed_totals["connections"] += connections_opened
+            _session.close()
+        _session = None
+        _adapter = None
+
+def stats() -> dict:
+    """
+    Connection stats across all pooled hosts.
+
+    `reuse_rate`: share of requests that were served over an already open connection.
+    """
+    requests_sent, connections_opened = _pool_counts()
+    requests_sent += _closed_totals["requests"]
+    connections_opened += _closed_totals["connections"]
+    if requests_sent:
+        reuse_rate = round(1 - (connections_opened / requests_sent), 3)
+    else:
+        reuse_rate = 0.0
+    return {
+        "requests": requests_sent,
+        "connections": connections_opened,
+        "reuse_rate": reuse_rate
+    }
@@ -12,7 +12,9 @@ import zipfile
 import sys
 from typing import Generator
 import string
+import json
 import inspect
+from contextlib import contextmanager
 
 def percent_of_string(string: str, percentage: int = 30):
     count = len(string)
@@ -92,6 +94,15 @@ def get_dir(folder: str, create_if_missing: bool = True):
     else:
         return dir_path.exists()
 
+def write_json_atomic(path, data):
+    """
+    Write `data` as JSON through a temporary file, so readers never see a partial file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
 def get_caller_path():
     frame = inspect.stack()[1]
     caller = frame.filename
@@ -128,6 +139,17 @@ def split_paragraph(paragraph:str):
         
     return first_half, second_half
 
+@contextmanager
+def timed(label: str, timings: dict):
+    """
+    Record how long the block took, in seconds, as `timings[label]`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[label] = time.perf_counter() - start
+
 def read_from_folder(path, extension=None):
     files = []
     for file in os.listdir(path):
@@ -0,0 +1,340 @@
+import numpy as np
+import threading
+import json
+import os
+
+# Rows appended since the vectors file was last mapped, kept in RAM until it's remapped
+TAIL_ROWS = 4096
+# Stored rows are scored this many at a time, bounding the float32 copy
+BLOCK_ROWS = 16384
+
+class NumpyCollection:
+    """
+    In-process brute-force vector collection with the subset of the chromadb collection API used by the memory stores.
+
+    Vectors are normalized and appended as float16 rows to a vectors file, which is memory-mapped, and records to
+    `records.jsonl`. Both files are append-only; deletes are logged as tombstones and the files are compacted once
+    most rows are dead. Distances are cosine distances (`1 - similarity`), like a chromadb collection in cosine space.
+    """
+    def __init__(self, path: str, embedding_function=None):
+        self.path = path
+        self.embedding_function = embedding_function
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self.dim = None
+        self.generation = 0
+        self._stored = None
+        self._mapped = 0
+        self._tail = np.zeros((0, 0), dtype=np.float16)
+        self._rows = 0
+        self._alive = np.zeros(0, dtype=bool)
+        self._ids = []
+        self._documents = []
+        self._metadatas = []
+        self._row_of = {}
+        self._columns = {}
+        self._load()
+
+    def _vectors_path(self, generation: int = None):
+        return os.path.join(self.path, f"vectors.{self.generation if generation is None else generation}.f16")
+
+    def _records_path(self):
+        return os.path.join(self.path, "records.jsonl")
+
+    def _load(self):
+        if not os.path.isfile(self._records_path()):
+            return
+        records = []
+        valid = 0
+        with open(self._records_path(), "rb") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Partial line from an interrupted write
+                    break
+                valid += len(line)
+        if valid < os.path.getsize(self._records_path()):
+            # Later appends would otherwise land after the partial line and be lost on the next load
+            with open(self._records_path(), "r+b") as file:
+                file.truncate(valid)
+        if records and "generation" in records[0]:
+            self.generation = records.pop(0)["generation"]
+        rows = sum(1 for record in records if "row" in record)
+        if rows:
+            self.dim = records[0]["dim"]
+            size = os.path.getsize(self._vectors_path()) if os.path.isfile(self._vectors_path()) else 0
+            rows = min(rows, size // (self.dim * 2))
+            if size > rows * self.dim * 2:
+                # Rows without a record, new rows must line up with their records
+                with open(self._vectors_path(), "r+b") as file:
+                    file.truncate(rows * self.dim * 2)
+            # Vectors are mapped once the records are in, only the alive flags live in RAM
+            self._alive = np.zeros(max(rows, 1024), dtype=bool)
+        for record in records:
+            if "row" in record:
+                if record["row"] >= rows:
+                    break
+                self._append_record(record["id"], record["document"], record["metadata"])
+            else:
+                self._delete_row(record["id"])
+        self._rows = len(self._ids)
+        self._remap()
+
+    def _remap(self):
+        """
+        Map every row written so far from the vectors file, emptying the in-memory tail.
+        """
+        self._stored = np.memmap(self._vectors_path(), dtype=np.float16, mode="r", shape=(self._rows, self.dim)) if self._rows else None
+        self._mapped = self._rows
+
+    def _reserve(self, rows: int):
+        if rows > len(self._alive):
+            alive = np.zeros(max(rows, len(self._alive) * 2, 1024), dtype=bool)
+            alive[:self._rows] = self._alive[:self._rows]
+            self._alive = alive
+        tail_rows = rows - self._mapped
+        if tail_rows > len(self._tail) or self._tail.shape[1] != self.dim:
+            tail = np.zeros((max(tail_rows, len(self._tail) * 2, 256), self.dim), dtype=np.float16)
+            if self._rows > self._mapped:
+                tail[:self._rows - self._mapped] = self._tail[:self._rows - self._mapped]
+            self._tail = tail
+
+    def _vectors(self, rows) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        vectors = np.empty((len(rows), self.dim or 0), dtype=np.float32)
+        mapped = rows < self._mapped
+        if mapped.any():
+            vectors[mapped] = self._stored[rows[mapped]]
+        if not mapped.all():
+            vectors[~mapped] = self._tail[rows[~mapped] - self._mapped]
+        return vectors
+
+    def _similarity(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Similarity of each query to every row, upcasting the float16 rows one block at a time.
+        """
+        scores = []
+        for start in range(0, self._mapped, BLOCK_ROWS):
+            scores.append(queries @ self._stored[start:start + BLOCK_ROWS].astype(np.float32).T)
+        if self._rows > self._mapped:
+            scores.append(queries @ self._tail[:self._rows - self._mapped].astype(np.float32).T)
+        return np.concatenate(scores, axis=1) if scores else np.zeros((len(queries), 0), dtype=np.float32)
+
+    def _append_record(self, _id: str, document: str, metadata: dict):
+        if _id in self._row_of:
+            self._delete_row(_id)
+        row = len(self._ids)
+        self._ids.append(_id)
+        self._documents.append(document)
+        self._metadatas.append(metadata)
+        self._row_of[_id] = row
+        self._alive[row] = True
+
+    def _delete_row(self, _id: str):
+        row = self._row_of.pop(_id, None)
+        if row is not None:
+            self._alive[row] = False
+
+    def _normalize(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+    def _write(self, ids: list, embeddings, documents: list, metadatas: list):
+        if embeddings is None:
+            embeddings = self.embedding_function(documents)
+        vectors = self._normalize(embeddings)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            start = self._rows
+            self._reserve(start + len(ids))
+            vectors = vectors.astype(np.float16)
+            self._tail[start - self._mapped:start - self._mapped + len(ids)] = vectors
+            with open(self._vectors_path(), "ab") as file:
+                file.write(vectors.tobytes())
+            with open(self._records_path(), "a", encoding="utf-8") as file:
+                for i, (_id, document, metadata) in enumerate(zip(ids, documents, metadatas)):
+                    file.write(json.dumps({"id": _id, "row": start + i, "dim": self.dim, "document": document, "metadata": metadata}) + "\n")
+                    self._append_record(_id, document, metadata)
+            self._rows = len(self._ids)
+            self._columns = {}
+            if self._rows - self._mapped >= TAIL_ROWS:
+                self._remap()
+
+    def add(self, ids: list, embeddings=None, metadatas: list = None, documents: list = None):
+        with self._lock:
+            existing = [_id for _id in ids if _id in self._row_of]
+        if existing:
+            raise ValueError(f"IDs already exist: {existing[:5]}")
+        self._write(list(ids), embeddings, documents, metadatas)
+
+    def upsert(self, ids: list, embeddings=None, metadatas: list = None, documents: list = None):
+        self._write(list(ids), embeddings, documents, metadatas)
+
+    def update(self, ids: list, embeddings=None, metadatas: list = None, documents: list = None):
+        with self._lock:
+            rows = [self._row_of[_id] for _id in ids]
+            if embeddings is None and documents is None:
+                embeddings = self._vectors(rows)
+            documents = documents or [self._documents[row] for row in rows]
+            metadatas = metadatas or [self._metadatas[row] for row in rows]
+        self._write(list(ids), embeddings, documents, metadatas)
+
+    def _column(self, key: str) -> np.ndarray:
+        column = self._columns.get(key)
+        if column is None:
+            column = np.empty(self._rows, dtype=object)
+            column[:] = [(metadata or {}).get(key) for metadata in self._metadatas]
+            self._columns[key] = column
+        return column
+
+    def _mask(self, where: dict = None, where_document: dict = None) -> np.ndarray:
+        mask = self._alive[:self._rows].copy()
+        for key, condition in (where or {}).items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self._mask(clause)
+                continue
+            operator, value = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+            column = self._column(key)
+            if operator == "$eq":
+                mask &= column == value
+            elif operator == "$ne":
+                mask &= column != value
+            elif operator == "$in":
+                mask &= np.isin(column, value)
+            else:
+                raise ValueError(f"Unsupported where operator: {operator}")
+        if where_document:
+            text = where_document.get("$contains")
+            mask &= np.array([text in (document or "") for document in self._documents], dtype=bool)
+        return mask
+
+    def _result(self, rows, include: list) -> dict:
+        result = {"ids": [self._ids[row] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [self._documents[row] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [self._metadatas[row] for row in rows]
+        if "embeddings" in include:
+            result["embeddings"] = self._vectors(rows).tolist()
+        return result
+
+    def get(self, ids: list = None, where: dict = None, limit: int = None, offset: int = None, where_document: dict = None, include: list = ["metadatas", "documents"]) -> dict:
+        with self._lock:
+            if ids is not None:
+                rows = [self._row_of[_id] for _id in ids if _id in self._row_of]
+            else:
+                rows = np.flatnonzero(self._mask(where, where_document)).tolist()
+            start = offset or 0
+            rows = rows[start:start + limit if limit is not None else None]
+            return self._result(rows, include)
+
+    def query(self, query_embeddings=None, query_texts: list = None, n_results: int = 10, where: dict = None, where_document: dict = None, include: list = ["metadatas", "documents", "distances"]) -> dict:
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+        queries = self._normalize(query_embeddings)
+        results = {"ids": [], "distances": []}
+        for key in ("documents", "metadatas", "embeddings"):
+            if key in include:
+                results[key] = []
+        with self._lock:
+            candidates = np.flatnonzero(self._mask(where, where_document))
+            k = min(n_results, len(candidates))
+            if k:
+                # Score every row and pick the candidates, cheaper than copying them out first
+                similarity = self._similarity(queries)[:, candidates]
+            for q in range(len(queries)):
+                rows = []
+                distances = []
+                if k:
+                    top = np.argpartition(-similarity[q], k - 1)[:k]
+                    top = top[np.argsort(-similarity[q][top])]
+                    rows = candidates[top].tolist()
+                    distances = (1 - similarity[q][top]).tolist()
+                result = self._result(rows, include)
+                results["ids"].append(result["ids"])
+                results["distances"].append(distances)
+                for key in ("documents", "metadatas", "embeddings"):
+                    if key in results:
+                        results[key].append(result[key])
+        return results
+
+    def delete(self, ids: list = None, where: dict = None, where_document: dict = None):
+        with self._lock:
+            if ids is None:
+                ids = [self._ids[row] for row in np.flatnonzero(self._mask(where, where_document))]
+            ids = [_id for _id in ids if _id in self._row_of]
+            if not ids:
+                return
+            with open(self._records_path(), "a", encoding="utf-8") as file:
+                for _id in ids:
+                    file.write(json.dumps({"id": _id}) + "\n")
+                    self._delete_row(_id)
+            if self._rows > 1024 and len(self._row_of) < self._rows / 2:
+                self._compact()
+
+    def _compact(self):
+        """
+        Rewrite both files with live rows only.
+        """
+        rows = np.flatnonzero(self._alive[:self._rows])
+        records = [(self._ids[row], self._documents[row], self._metadatas[row]) for row in rows]
+        old_vectors_path = self._vectors_path()
+        generation = self.generation + 1
+        with open(self._vectors_path(generation), "wb") as file:
+            for start in range(0, len(rows), BLOCK_ROWS):
+                file.write(self._vectors(rows[start:start + BLOCK_ROWS]).astype(np.float16).tobytes())
+        with open(f"{self._records_path()}.tmp", "w", encoding="utf-8") as file:
+            file.write(json.dumps({"generation": generation}) + "\n")
+            for i, (_id, document, metadata) in enumerate(records):
+                file.write(json.dumps({"id": _id, "row": i, "dim": self.dim, "document": document, "metadata": metadata}) + "\n")
+        # Swapping the records is the commit point, they name the vectors file they index into
+        os.replace(f"{self._records_path()}.tmp", self._records_path())
+        # Unmapped first, Windows can't remove a mapped file
+        self._stored = None
+        os.remove(old_vectors_path)
+        self.generation = generation
+        self._alive[:] = False
+        self._alive[:len(rows)] = True
+        self._ids = [_id for _id, _, _ in records]
+        self._documents = [document for _, document, _ in records]
+        self._metadatas = [metadata for _, _, metadata in records]
+        self._row_of = {_id: i for i, _id in enumerate(self._ids)}
+        self._rows = len(rows)
+        self._columns = {}
+        self._remap()
+
+    def count(self) -> int:
+        return len(self._row_of)
+
+class NumpyClient:
+    """
+    Drop-in for `chromadb.PersistentClient`, storing each collection under `<path>/numpy/<name>`.
+    """
+    max_batch_size = 5000
+
+    def __init__(self, path: str):
+        self.path = os.path.join(path, "numpy")
+        self._collections = {}
+
+    def get_or_create_collection(self, name: str, embedding_function=None, metadata: dict = None) -> NumpyCollection:
+        if name not in self._collections:
+            self._collections[name] = NumpyCollection(os.path.join(self.path, name), embedding_function)
+        elif embedding_function is not None:
+            # Like chromadb, the embedding function is bound per call
+            self._collections[name].embedding_function = embedding_function
+        return self._collections[name]
+
+    def list_collections(self) -> list[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.listdir(self.path))
+
+    def delete_collection(self, name: str):
+        import shutil
+        self._collections.pop(name, None)
+        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)